@@ -0,0 +1,177 @@
+"""
+The CloudWatch log event queue shared by the v1 and v2 request analytics
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import boto3
+
+__all__ = ['LogEventQueue', 'log_queue']
+
+LOG_GROUP_NAME = os.getenv('AWS_LOG_GROUP_NAME')
+LOG_STREAM_NAME = os.getenv('AWS_LOG_STREAM_NAME')
+ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
+SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
+REGION = os.getenv('AWS_REGION')
+LOG_QUEUE_SIZE = int(os.getenv('ANALYTICS_LOG_QUEUE_SIZE', 10_000))
+LOG_BATCH_SIZE = int(os.getenv('ANALYTICS_LOG_BATCH_SIZE', 500))
+LOG_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_LOG_FLUSH_INTERVAL', 5))
+
+# seconds to wait for the background thread to send the batch it holds when the process exits
+CLOSE_TIMEOUT = 10
+
+# put in the queue to wake the background thread when the queue is closed
+_STOP = object()
+
+logger = logging.getLogger()
+
+
+class LogEventQueue:
+    """
+    Buffers CloudWatch log events in memory and sends them in batches from a background thread so requests never wait
+    on the logging service. Events are dropped and counted when the queue is full.
+
+    Args:
+        client_factory: returns anything with a boto3 CloudWatch Logs style put_log_events method, called once in each
+            process that sends events
+        log_group_name: the CloudWatch log group
+        log_stream_name: the CloudWatch log stream within the group
+        max_size: the most events held in memory waiting to be sent
+        batch_size: the most events sent in one put_log_events call
+        flush_interval: seconds to wait for a full batch before sending a partial one
+        on_count: called with the event (queued, sent, dropped or failed) and the number of log events
+    """
+
+    def __init__(self, client_factory, log_group_name: str, log_stream_name: str, max_size: int = LOG_QUEUE_SIZE,
+                 batch_size: int = LOG_BATCH_SIZE, flush_interval: float = LOG_FLUSH_INTERVAL, on_count=None):
+        self.client_factory = client_factory
+        self.log_group_name = log_group_name
+        self.log_stream_name = log_stream_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_count = on_count
+        self.events = queue.Queue(maxsize=max_size)
+        self.counts = {'queued': 0, 'sent': 0, 'dropped': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._closing = False
+        self._thread = None
+        self._thread_pid = None
+        self._client = None
+        self._client_pid = None
+
+    def put(self, message: dict) -> bool:
+        """
+        Queues a message to be sent. Returns False if the queue was full and the message was dropped.
+        """
+        self._ensure_worker()
+        event = {'timestamp': int(round(time.time() * 1000)), 'message': json.dumps(message)}
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('queued')
+        return True
+
+    def flush(self) -> None:
+        """
+        Sends every event currently in the queue
+        """
+        while self._send_batch(self._take_batch(block=False)):
+            pass
+
+    def close(self) -> None:
+        """
+        Stops the background thread once it has sent the batch it is collecting, then sends the rest of the queue
+        """
+        self._closing = True
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            try:
+                self.events.put_nowait(_STOP)
+            except queue.Full:
+                pass  # the thread does not wait for events while the queue is full
+            self._thread.join(CLOSE_TIMEOUT)
+        self.flush()
+
+    def _ensure_worker(self) -> None:
+        # threads do not survive a fork so the uwsgi workers each start their own the first time they log
+        if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='analytics-log-queue', daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closing:
+            self._send_batch(self._take_batch(block=True))
+
+    def _take_batch(self, block: bool) -> list:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    event = self.events.get(timeout=timeout)
+                else:
+                    event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event is _STOP:
+                break
+            batch.append(event)
+        return batch
+
+    def _send_batch(self, batch: list) -> int:
+        if not batch:
+            return 0
+        # put_log_events rejects batches that are not in chronological order and events queued by different threads
+        # can be taken out of the queue out of order
+        batch.sort(key=lambda event: event['timestamp'])
+        try:
+            with self._send_lock:
+                self._get_client().put_log_events(
+                    logGroupName=self.log_group_name,
+                    logStreamName=self.log_stream_name,
+                    logEvents=batch,
+                )
+            self._count('sent', len(batch))
+        except Exception as e:
+            self._count('failed', len(batch))
+            logger.error(f'Failed to send {len(batch)} analytics log events: {e}')
+        return len(batch)
+
+    def _get_client(self):
+        # the connection pool of a client made before a fork would be shared with the parent so each process makes one
+        if self._client is None or self._client_pid != os.getpid():
+            self._client = self.client_factory()
+            self._client_pid = os.getpid()
+        return self._client
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[key] += n
+        if self.on_count is not None:
+            self.on_count(key, n)
+
+
+def _cloudwatch_client():
+    return boto3.client(
+        'logs',
+        aws_access_key_id=ACCESS_KEY_ID,
+        aws_secret_access_key=SECRET_ACCESS_KEY,
+        region_name=REGION
+    )
+
+
+log_queue = LogEventQueue(_cloudwatch_client, LOG_GROUP_NAME, LOG_STREAM_NAME)
+atexit.register(log_queue.close)
@@ -4,6 +4,7 @@ from flask import Flask
 from flask_cors import CORS
 
 from blueprint_pages import app as blueprint_pages
+from warmup import warm_up
 import v2
 import v1
 
@@ -25,6 +26,11 @@ app.register_blueprint(blueprint_pages)
 app.register_blueprint(v2.V2BLUEPRINT)
 app.register_blueprint(v1.V1BLUEPRINT)
 
+# >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> WARM UP
+# uwsgi loads this module in the master process before forking so the workers inherit the warm state
+if os.getenv('APP_WARMUP', 'true').lower() == 'true':
+    warm_up(app)
+
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> __main__
 if __name__ == '__main__':
     app.run()
@@ -1,32 +1,9 @@
-import json
-import logging
-import os
-import time
-
-import boto3
-
-LOG_GROUP_NAME = os.getenv('AWS_LOG_GROUP_NAME')
-LOG_STREAM_NAME = os.getenv('AWS_LOG_STREAM_NAME')
-ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
-SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
-REGION = os.getenv('AWS_REGION')
-
-# Create a CloudWatch Logs client
-client = boto3.client(
-    'logs',
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=SECRET_ACCESS_KEY,
-    region_name=REGION
-)
-
-# Set up logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+from analytics_queue import log_queue
 
 
 def log_request(version: str, product: str, reach_id: int, return_format: str, source: str):
     """
-    Posts a custom log to the aws cloudwatch logging service
+    Queues a custom log to be posted to the aws cloudwatch logging service in the background
 
     Requires environment variables
     - AWS_LOG_GROUP_NAME: the group name for the AWS CloudWatch log group within "logs".
@@ -49,7 +26,7 @@ def log_request(version: str, product: str, reach_id: int, return_format: str, s
         )
 
     Returns:
-        the response from the CloudWatch service
+        False if the log queue was full and the message was dropped, otherwise True
     """
     log_message = {
         'version': version,
@@ -59,15 +36,5 @@ def log_request(version: str, product: str, reach_id: int, return_format: str, s
         'source': source,
     }
 
-    # Send the log message to CloudWatch
-    response = client.put_log_events(
-        logGroupName=LOG_GROUP_NAME,
-        logStreamName=LOG_STREAM_NAME,
-        logEvents=[
-            {
-                'timestamp': int(round(time.time() * 1000)),
-                'message': json.dumps(log_message)
-            }
-        ]
-    )
-    return response
+    # Queue the log message to be sent to CloudWatch in the background
+    return log_queue.put(log_message)
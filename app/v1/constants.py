@@ -1,5 +1,8 @@
-PATH_TO_FORECASTS = '/mnt/output/forecasts'
-PATH_TO_FORECAST_RECORDS = '/mnt/output/forecast-records'
-PATH_TO_ERA_INTERIM = '/mnt/output/era-interim'
-PATH_TO_ERA_5 = '/mnt/output/era-5'
+import os
+
+PATH_TO_FORECASTS = os.getenv('V1_PATH_TO_FORECASTS', '/mnt/output/forecasts')
+PATH_TO_FORECAST_RECORDS = os.getenv('V1_PATH_TO_FORECAST_RECORDS', '/mnt/output/forecast-records')
+PATH_TO_ERA_INTERIM = os.getenv('V1_PATH_TO_ERA_INTERIM', '/mnt/output/era-interim')
+PATH_TO_ERA_5 = os.getenv('V1_PATH_TO_ERA_5', '/mnt/output/era-5')
+PATH_TO_GEOMETRY = os.getenv('V1_PATH_TO_GEOMETRY', '/app/geometry')
 M3_TO_FT3 = 35.3146667
\ No newline at end of file
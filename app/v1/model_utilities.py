@@ -1,10 +1,15 @@
 import json
+import os
 import pickle
 from collections import OrderedDict
+from functools import lru_cache
 
 import pandas as pd
-from shapely.geometry import Point, MultiPoint, shape
-from shapely.ops import nearest_points
+from scipy.spatial import cKDTree
+from shapely import STRtree, prepare
+from shapely.geometry import Point, shape
+
+from .constants import PATH_TO_GEOMETRY
 
 
 def reach_to_region(reach_id=None):
@@ -53,18 +58,10 @@ def latlon_to_reach(lat: float, lon: float) -> tuple:
     # determine the region that the point is in
     region = latlon_to_region(lat, lon)
 
-    # switch the point because the csv's are lat/lon, backwards from what shapely expects (lon then lat)
-    point = Point(float(lat), float(lon))
-
-    # open the region csv
-    df = pd.read_pickle(f'/app/geometry/{region}-comid_lat_lon_z.pickle')
-    points_df = df.loc[:, "Lat":"Lon"].apply(Point, axis=1)
-
-    # determine which point is closest
-    multi_pt = MultiPoint(points_df.tolist())
-    nearest_pt = nearest_points(point, multi_pt)
-    reach_id = int(points_df[points_df == nearest_pt[1]].index[0])
-    distance = nearest_pt[0].distance(nearest_pt[1])
+    # determine which point is closest. the pickles are lat/lon so query with the point in that order
+    tree, reach_ids = _region_reach_index(region)
+    distance, position = tree.query((float(lat), float(lon)))
+    reach_id = int(reach_ids[position])
 
     # if the nearest stream if more than .1 degrees away, you probably didn't find the right stream
     if distance > 0.11:
@@ -77,13 +74,38 @@ def latlon_to_region(lat, lon):
     # create a shapely point for the querying
     point = Point(float(lon), float(lat))
 
+    tree, polygon_regions = region_boundaries_index()
+    # the polygons are indexed in the order of the boundaries pickle so the smallest match is the first region found
+    matches = tree.query(point, predicate='within')
+    if len(matches):
+        return f'{polygon_regions[min(matches)]}-geoglows'
+    # if there weren't any regions, return that there was an error
+    raise ValueError('This lat/lon point is not within any of the supported delineation regions.')
+
+
+@lru_cache(maxsize=None)
+def _region_reach_index(region: str) -> tuple:
+    """
+    KD-tree of the lat/lon of every reach in a region, built once per worker
+    """
+    df = pd.read_pickle(os.path.join(PATH_TO_GEOMETRY, f'{region}-comid_lat_lon_z.pickle'))
+    return cKDTree(df.loc[:, "Lat":"Lon"].values), df.index.values
+
+
+@lru_cache(maxsize=None)
+def region_boundaries_index() -> tuple:
+    """
+    STRtree of the prepared region boundary polygons and the region name of each polygon, built once per worker
+    """
     # read the boundaries pickle
-    bounds_pickle = '/app/geometry/boundaries.pickle'
+    bounds_pickle = os.path.join(PATH_TO_GEOMETRY, 'boundaries.pickle')
     with open(bounds_pickle, 'rb') as f:
         region_bounds = json.loads(pickle.load(f))
+    polygons = []
+    polygon_regions = []
     for region in region_bounds:
         for polygon in region_bounds[region]['features']:
-            if shape(polygon['geometry']).contains(point):
-                return f'{region}-geoglows'
-    # if there weren't any regions, return that there was an error
-    raise ValueError('This lat/lon point is not within any of the supported delineation regions.')
+            polygons.append(shape(polygon['geometry']))
+            polygon_regions.append(region)
+    prepare(polygons)
+    return STRtree(polygons), polygon_regions
@@ -1,28 +1,20 @@
-import json
 import logging
 import os
-import time
 
-import boto3
+from analytics_queue import log_queue
+
+from .metrics import count_analytics_event
 
-LOG_GROUP_NAME = os.getenv('AWS_LOG_GROUP_NAME')
-LOG_STREAM_NAME = os.getenv('AWS_LOG_STREAM_NAME')
 ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
 SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
-REGION = os.getenv('AWS_REGION')
-
-# Create a CloudWatch Logs client
-client = boto3.client(
-    'logs',
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=SECRET_ACCESS_KEY,
-    region_name=REGION
-)
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# the queue is shared with v1, its events are counted in the worker metrics served by v2
+log_queue.on_count = count_analytics_event
+
 
 def log_request(version: str, product: str, river_id: int, return_format: str, source: str):
     log_message = {
@@ -37,15 +29,5 @@ def log_request(version: str, product: str, river_id: int, return_format: str, s
         logger.error('AWS credentials not available')
         return
 
-    # Send the log message to CloudWatch
-    response = client.put_log_events(
-        logGroupName=LOG_GROUP_NAME,
-        logStreamName=LOG_STREAM_NAME,
-        logEvents=[
-            {
-                'timestamp': int(round(time.time() * 1000)),
-                'message': json.dumps(log_message)
-            }
-        ]
-    )
-    return response
+    # Queue the log message to be sent to CloudWatch in the background
+    return log_queue.put(log_message)
@@ -1,8 +1,7 @@
 import logging
 import traceback
 
-import geoglows
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, make_response
 from flask_cors import cross_origin
 
 from .analytics import log_request
@@ -11,7 +10,8 @@ from .controllers_forecasts import (forecast,
                                     forecast_ensemble,
                                     forecast_records,
                                     forecast_dates,
-                                    hydroviewer, )
+                                    hydroviewer,
+                                    HydroviewerTimeoutError, )
 from .controllers_historical import (retrospective_hourly,
                                      retrospective_daily,
                                      retrospective_monthly,
@@ -20,6 +20,12 @@ from .controllers_historical import (retrospective_hourly,
                                      yearly_averages,
                                      return_periods)
 from .controllers_misc import get_river_id
+from .constants import MAX_RIVERS_PER_REQUEST
+from .data import is_valid_river_id, latlon_to_river_id
+from .metrics import stage, start_request_timer, finish_request_timer, metrics_response
+from .http_cache import request_validator, is_not_modified, not_modified_response, add_validator_headers
+from .response_cache import get_cached_response, cache_response
+from .response_formatters import BINARY_FORMATS
 
 logger = logging.getLogger("DEBUG")
 
@@ -30,18 +36,61 @@ app = Blueprint('rest-endpoints-v2', __name__)
 @app.route(f'/api/v2/<product>/<river_id>', methods=['GET'])
 @cross_origin()
 def rest_endpoints_v2(product: str, river_id: int = None):
-    product, river_id, return_format, date, start_date, end_date, bias_corrected = handle_request(
-        request,
-        product,
-        river_id,
+    timer = start_request_timer()
+    with stage('params'):
+        product, river_id, return_format, date, start_date, end_date, bias_corrected = handle_request(
+            request,
+            product,
+            river_id,
+        )
+    timer.product = product
+    timer.return_format = return_format
+
+    # the synthetic requests made while warming up the workers are not usage
+    if request.args.get('source') != 'warmup':
+        with stage('log'):
+            log_request(version="v2",
+                        product=product,
+                        river_id=river_id,
+                        return_format=return_format,
+                        source=request.args.get('source', 'other'), )
+    else:
+        timer.record = False
+
+    # answer conditional requests for data that has not changed before reading any of it
+    with stage('validate'):
+        validator = request_validator(product, river_id, return_format, date, start_date, end_date, bias_corrected,
+                                      lat=request.args.get('lat'), lon=request.args.get('lon'))
+        if validator is not None and is_not_modified(request, validator):
+            return not_modified_response(validator)
+
+    # responses are shared between workers by the etag of the normalized request
+    if validator is not None:
+        with stage('cache'):
+            cached_response = get_cached_response(validator['etag'])
+        if cached_response is not None:
+            return add_validator_headers(cached_response, validator)
+
+    response = make_response(
+        get_product(product, river_id, return_format, date, start_date, end_date, bias_corrected)
     )
+    if validator is not None and response.status_code == 200:
+        add_validator_headers(response, validator)
+        with stage('cache'):
+            cache_response(validator['etag'], response, validator['max_age'])
+    return response
+
+
+# adds the Server-Timing header and records the request metrics, including for the errors answered below
+app.after_request(finish_request_timer)
+
 
-    log_request(version="v2",
-                product=product,
-                river_id=river_id,
-                return_format=return_format,
-                source=request.args.get('source', 'other'), )
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics_response()
 
+
+def get_product(product, river_id, return_format, date, start_date, end_date, bias_corrected):
     # forecast data products
     if product == 'dates':
         return forecast_dates(return_format=return_format)
@@ -102,6 +151,16 @@ def python_package_log_endpoint():
     return jsonify({'success': True, 'message': 'request logged'}), 200
 
 
+def validate_river_id(river_id) -> int:
+    try:
+        river_id = str(river_id).replace(' ', '').replace('_', '').replace('-', '')
+        river_id = int(river_id)
+        assert is_valid_river_id(river_id)
+    except Exception:
+        raise ValueError("river_id must be a 9 digit integer of a valid river ID")
+    return river_id
+
+
 def handle_request(request, product, river_id):
     ALL_PRODUCTS = {
         'getriverid',
@@ -148,7 +207,18 @@ def handle_request(request, product, river_id):
         'yearavg': 'annualaverages',
         'yearlyaverages': 'annualaverages',
     }
-    return_formats = ('csv', 'json',)
+    # products that accept a comma separated list of river IDs
+    MULTI_RIVER_PRODUCTS = {
+        'forecast',
+        'forecaststats',
+        'forecastensemble',
+    }
+    # products that answer with json whatever the format and cannot be written as a table
+    JSON_ONLY_PRODUCTS = {
+        'getriverid',
+        'hydroviewer',
+    }
+    return_formats = ('csv', 'json', *BINARY_FORMATS)
 
     product = str(product).lower().replace(' ', '').replace('_', '').replace('-', '')
     if product not in ALL_PRODUCTS:
@@ -162,24 +232,31 @@ def handle_request(request, product, river_id):
     elif river_id is None:  # all other products require an ID - try to find it from the lat/lon
         if request.args.get('lat', None) and request.args.get('lon', None):
             try:
-                river_id = geoglows.streams.latlon_to_river(
+                river_id = latlon_to_river_id(
                     float(request.args.get('lat')), float(request.args.get('lon'))
                 )
             except Exception:
                 raise ValueError('invalid lat/lon provided')
         else:
             raise ValueError('you must specify a river ID number for this dataset')
+    elif ',' in str(river_id):  # a comma separated list of river IDs for the products that can read many at once
+        if product not in MULTI_RIVER_PRODUCTS:
+            raise ValueError(f'only {MULTI_RIVER_PRODUCTS} accept more than one river ID per request')
+        river_id = list(dict.fromkeys(validate_river_id(r) for r in str(river_id).split(',') if r.strip()))
+        if not river_id:
+            raise ValueError('you must specify a river ID number for this dataset')
+        if len(river_id) > MAX_RIVERS_PER_REQUEST:
+            raise ValueError(f'at most {MAX_RIVERS_PER_REQUEST} river IDs can be requested at once')
+        if request.args.get('bias_corrected', 'false').lower() in ['true']:
+            raise ValueError('bias correction is only available when requesting a single river ID')
     elif river_id is not None:  # otherwise do a simple check that the river_id might be valid
-        try:
-            river_id = str(river_id).replace(' ', '').replace('_', '').replace('-', '')
-            river_id = int(river_id)
-            assert river_id > 110_000_000
-        except Exception:
-            raise ValueError("river_id must be a 9 digit integer of a valid river ID")
+        river_id = validate_river_id(river_id)
 
     return_format = request.args.get('format', 'csv')
     if return_format not in return_formats:
-        raise ValueError('format not recognized. must be either "json" or "csv"')
+        raise ValueError(f'format not recognized. must be one of {return_formats}')
+    if return_format in BINARY_FORMATS and product in JSON_ONLY_PRODUCTS:
+        raise ValueError(f'{product} is not available in the {return_format} format')
 
     date = request.args.get('date', 'latest')
     start_date = request.args.get('start_date', None)
@@ -203,6 +280,12 @@ def errors_value_error(e: ValueError):
     return jsonify({"error": f"Invalid request: {e}"}), 400
 
 
+@app.errorhandler(HydroviewerTimeoutError)
+def errors_hydroviewer_timeout(e: HydroviewerTimeoutError):
+    logger.debug(traceback.format_exc())
+    return jsonify({"error": f"Request timed out: {e}"}), 504
+
+
 @app.errorhandler(Exception)
 def errors_general_exception(e: Exception):
     logger.debug(traceback.format_exc())
@@ -0,0 +1,40 @@
+"""
+Converts the package and extra metadata parquet tables into LINKNO sorted .npy column files that the workers memory map
+instead of parsing the parquet files. Every worker maps the same files so they share one copy of the pages in memory.
+
+Run it when the metadata tables are downloaded, from the directory that contains the v2 package (/app):
+
+    python -m v2.build_metadata_arrays
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from .constants import PACKAGE_METADATA_TABLE_PATH, PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH, METADATA_ARRAYS_DIR
+
+__all__ = [
+    'build_metadata_arrays',
+    'METADATA_ARRAY_TABLES',
+]
+
+# the columns written from each table. each table is written as <table>_<column>.npy
+METADATA_ARRAY_TABLES = {
+    'package': (PACKAGE_METADATA_TABLE_PATH, ['LINKNO', 'VPUCode']),
+    'extra': (PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH, ['LINKNO', 'lat', 'lon']),
+}
+
+
+def build_metadata_arrays(output_dir: str = METADATA_ARRAYS_DIR) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    for table, (table_path, columns) in METADATA_ARRAY_TABLES.items():
+        df = pd.read_parquet(table_path, columns=columns).sort_values('LINKNO', kind='stable')
+        for column in columns:
+            values = df[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)  # fixed width strings can be memory mapped, python objects cannot
+            np.save(os.path.join(output_dir, f'{table}_{column}.npy'), np.ascontiguousarray(values))
+
+
+if __name__ == '__main__':
+    build_metadata_arrays()
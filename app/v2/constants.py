@@ -1,7 +1,7 @@
 import os
 
-PATH_TO_FORECASTS = "/mnt/output/v2/forecasts"
-PATH_TO_FORECAST_RECORDS = "/mnt/output/v2/forecast-records"
+PATH_TO_FORECASTS = os.getenv("V2_PATH_TO_FORECASTS", "/mnt/output/v2/forecasts")
+PATH_TO_FORECAST_RECORDS = os.getenv("V2_PATH_TO_FORECAST_RECORDS", "/mnt/output/v2/forecast-records")
 PACKAGE_METADATA_TABLE_PATH = os.getenv(
     "PYGEOGLOWS_METADATA_TABLE_PATH", "/app/package-metadata-table.parquet"
 )
@@ -9,3 +9,25 @@ PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH = os.getenv(
     "PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH", "/app/extra-metadata-table.parquet"
 )
 NUM_DECIMALS = 1
+FORECAST_DATASET_CACHE_SIZE = int(os.getenv("FORECAST_DATASET_CACHE_SIZE", 4))
+FORECAST_RECORDS_CACHE_SIZE = int(os.getenv("FORECAST_RECORDS_CACHE_SIZE", 16))
+FORECAST_STATS_RIVID_CHUNK_SIZE = int(os.getenv("FORECAST_STATS_RIVID_CHUNK_SIZE", 10_000))
+FORECAST_RIVERS_PER_CHUNK = int(os.getenv("FORECAST_RIVERS_PER_CHUNK", 128))
+MAX_RIVERS_PER_REQUEST = int(os.getenv("MAX_RIVERS_PER_REQUEST", 500))
+RETRO_CACHE_DIR = os.getenv("RETRO_CACHE_DIR", "/tmp/geoglows-retro-cache")
+RETRO_CACHE_MAX_BYTES = int(os.getenv("RETRO_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+RETRO_SOURCE_DIR = os.getenv("RETRO_SOURCE_DIR", None)
+RETRO_VERSION = os.getenv("RETRO_VERSION", "v2")
+HYDROVIEWER_STAGE_TIMEOUT = float(os.getenv("HYDROVIEWER_STAGE_TIMEOUT", 60))
+HYDROVIEWER_THREADS = int(os.getenv("HYDROVIEWER_THREADS", 12))
+CSV_STREAM_BLOCK_ROWS = int(os.getenv("CSV_STREAM_BLOCK_ROWS", 20_000))
+CACHE_MAX_AGE_FORECAST_DATE = int(os.getenv("CACHE_MAX_AGE_FORECAST_DATE", 7 * 24 * 3600))
+CACHE_MAX_AGE_FORECAST_LATEST = int(os.getenv("CACHE_MAX_AGE_FORECAST_LATEST", 3600))
+CACHE_MAX_AGE_FORECAST_RECORDS = int(os.getenv("CACHE_MAX_AGE_FORECAST_RECORDS", 3600))
+CACHE_MAX_AGE_RETROSPECTIVE = int(os.getenv("CACHE_MAX_AGE_RETROSPECTIVE", 7 * 24 * 3600))
+CACHE_MAX_AGE_DATES = int(os.getenv("CACHE_MAX_AGE_DATES", 300))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "/tmp/geoglows-response-cache")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 1024 ** 3))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", 20 * 1024 ** 2))
+METADATA_ARRAYS_DIR = os.getenv("METADATA_ARRAYS_DIR", "/app/metadata-arrays")
+METRICS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "/tmp/geoglows-metrics")
@@ -1,20 +1,33 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
-from flask import jsonify
+from flask import Response, jsonify
 import geoglows
 
-from .constants import NUM_DECIMALS, PACKAGE_METADATA_TABLE_PATH
+from .constants import NUM_DECIMALS, HYDROVIEWER_STAGE_TIMEOUT, HYDROVIEWER_THREADS
 from .data import (
     get_forecast_dataset,
-    get_forecast_records_dataset,
+    get_precomputed_forecast_stats,
+    get_forecast_records,
     find_available_dates,
+    find_latest_date,
+    get_vpu,
 )
 from .controllers_historical import return_periods
+from .ensemble_stats import forecast_statistics, FORECAST_STATISTICS_COLUMNS
+from .metrics import stage
 from .response_formatters import (
+    BINARY_FORMATS,
+    df_to_binary_flask_response,
     df_to_jsonify_response,
     df_to_csv_flask_response,
+    dict_to_json_response,
     new_json_template,
 )
 
@@ -25,14 +38,54 @@ __all__ = [
     "forecast_ensemble",
     "forecast_records",
     "forecast_dates",
+    "HydroviewerTimeoutError",
 ]
 
+# thread pool shared by the hydroviewer requests of a worker
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
 
-def hydroviewer(river_id: int, date: str, records_start: str, bias_corrected: bool = False) -> jsonify:
+
+class HydroviewerTimeoutError(Exception):
+    """
+    A stage of a hydroviewer request did not finish within HYDROVIEWER_STAGE_TIMEOUT seconds
+    """
+
+
+def hydroviewer(river_id: int, date: str, records_start: str, bias_corrected: bool = False) -> Response:
     if date == "latest":
-        date = find_available_dates()[-1]
-    forecast_df = forecast(river_id, date, "df", bias_corrected=bias_corrected)
-    rperiods = return_periods(river_id, return_format="df", bias_corrected=bias_corrected)
+        date = find_latest_date()
+
+    # the forecast, return periods and records are read from different sources so fetch them at the same time
+    executor = _get_executor()
+    deadline = time.monotonic() + HYDROVIEWER_STAGE_TIMEOUT
+    # each stage runs in a copy of the request's context so its work is timed with the request
+    stages = {
+        "forecast": executor.submit(
+            contextvars.copy_context().run, forecast, river_id, date, "df", bias_corrected=bias_corrected
+        ),
+        "return periods": executor.submit(
+            contextvars.copy_context().run, return_periods, river_id, return_format="df", bias_corrected=bias_corrected
+        ),
+    }
+    if records_start:
+        stages["forecast records"] = executor.submit(
+            contextvars.copy_context().run,
+            forecast_records, river_id, start_date=records_start, end_date=date[:8], return_format="df"
+        )
+    results = {}
+    for name, future in stages.items():
+        try:
+            results[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            for pending in stages.values():
+                pending.cancel()
+            raise HydroviewerTimeoutError(
+                f"hydroviewer {name} did not finish within {HYDROVIEWER_STAGE_TIMEOUT} seconds"
+            )
+    forecast_df = results["forecast"]
+    rperiods = results["return periods"]
 
     # add the columns from the dataframe
     json_template = new_json_template(
@@ -43,8 +96,8 @@ def hydroviewer(river_id: int, date: str, records_start: str, bias_corrected: bo
     
     if bias_corrected:
         json_template["metadata"]["series"] = (["datetime_forecast", "return_periods", "return_periods_original"] + forecast_df.columns.tolist())
-        json_template.update(forecast_df.to_dict(orient="list"))
-        json_template.update({"datetime_forecast": forecast_df.index.tolist()})
+        json_template.update({column: forecast_df[column].values for column in forecast_df.columns})
+        json_template.update({"datetime_forecast": forecast_df.index.values})
         json_template["return_periods_original"] = rperiods['return_periods_original'].to_dict()
         json_template["return_periods"] = rperiods['return_periods'].to_dict()
     else:
@@ -52,17 +105,12 @@ def hydroviewer(river_id: int, date: str, records_start: str, bias_corrected: bo
         rperiods.columns = ['return_period', river_id]  # Rename columns for clarity
         rperiods.set_index('return_period', inplace=True)
         json_template["metadata"]["series"] = (["datetime_forecast", "return_periods"] + forecast_df.columns.tolist())
-        json_template.update(forecast_df.to_dict(orient="list"))
-        json_template.update({"datetime_forecast": forecast_df.index.tolist()})
+        json_template.update({column: forecast_df[column].values for column in forecast_df.columns})
+        json_template.update({"datetime_forecast": forecast_df.index.values})
         json_template["return_periods"] = rperiods.to_dict(orient='dict')[river_id]
     
     if records_start:
-        records_df = forecast_records(
-            river_id,
-            start_date=records_start,
-            end_date=date[:8],
-            return_format="df",
-        )
+        records_df = results["forecast records"]
 
         try:
             records_df.rename(
@@ -73,116 +121,118 @@ def hydroviewer(river_id: int, date: str, records_start: str, bias_corrected: bo
 
         json_template["metadata"]["series"] += records_df.columns.tolist()
         json_template["metadata"]["series"] += ["datetime_records"]
-        json_template.update(records_df.to_dict(orient="list"))
-        json_template.update({"datetime_records": records_df.index.tolist()})
+        json_template.update({column: records_df[column].values for column in records_df.columns})
+        json_template.update({"datetime_records": records_df.index.values})
             
-    return jsonify(json_template), 200
+    return dict_to_json_response(json_template)
 
 
-def forecast(river_id: int, date: str, return_format: str, bias_corrected: bool = False) -> pd.DataFrame:
-    forecast_xarray_dataset = get_forecast_dataset(river_id, date)
-    # get an array of all the ensembles, delete the high res before doing averages
-    merged_array = forecast_xarray_dataset.data
-    merged_array = np.delete(
-        merged_array,
-        list(forecast_xarray_dataset.ensemble.data).index(52),
-        axis=0,
-    )
+def _get_executor() -> ThreadPoolExecutor:
+    # threads do not survive a fork so each uwsgi worker creates its own pool the first time it is needed
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=HYDROVIEWER_THREADS, thread_name_prefix="hydroviewer")
+            _executor_pid = os.getpid()
+        return _executor
 
-    # replace any values that went negative because of the routing
-    merged_array[merged_array <= 0] = 0
 
-    # load all the series into a dataframe
+def forecast(river_id: int, date: str, return_format: str, bias_corrected: bool = False) -> pd.DataFrame:
     df = (
-        pd.DataFrame(
-            {
-                f"flow_uncertainty_upper": np.nanpercentile(
-                    merged_array, 80, axis=0
-                ),
-                f"flow_median": np.median(merged_array, axis=0),
-                f"flow_uncertainty_lower": np.nanpercentile(
-                    merged_array, 20, axis=0
-                ),
-            },
-            index=forecast_xarray_dataset.time.data,
+        get_forecast_statistics(river_id, date)
+        .loc[:, ["flow_80p", "flow_med", "flow_20p"]]
+        .rename(
+            columns={
+                "flow_80p": "flow_uncertainty_upper",
+                "flow_med": "flow_median",
+                "flow_20p": "flow_uncertainty_lower",
+            }
         )
         .dropna()
         .astype(np.float64)
         .round(NUM_DECIMALS)
     )
-    df.index = df.index.strftime("%Y-%m-%dT%X+00:00")
-    df.index.name = "datetime"
+    df = _format_datetime_index(df)
     if bias_corrected:
         df.index = pd.to_datetime(df.index)
-        data = geoglows.bias.sfdc_bias_correction(df, river_id).round(NUM_DECIMALS)
+        with stage("bias"):
+            data = geoglows.bias.sfdc_bias_correction(df, river_id).round(NUM_DECIMALS)
         data = data.merge(df.add_suffix("_original"), left_index=True, right_index=True, how="left")
 
         if return_format == "csv":
             return df_to_csv_flask_response(data, f"forecast_{river_id}")
         if return_format == "json":
             return df_to_jsonify_response(df=data, river_id=river_id)
+        if return_format in BINARY_FORMATS:
+            return df_to_binary_flask_response(data, f"forecast_{river_id}", return_format)
         return data
     
     if return_format == "csv":
-        return df_to_csv_flask_response(df, f"forecast_{river_id}")
+        return df_to_csv_flask_response(df, f"forecast_{_river_id_label(river_id)}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"forecast_{_river_id_label(river_id)}", return_format)
     return df
 
 
 def forecast_stats(
     river_id: int, date: str, return_format: str, bias_corrected: bool = False,
 ) -> pd.DataFrame:
-    forecast_xarray_dataset = get_forecast_dataset(river_id, date)
-
-    # get an array of all the ensembles, delete the high res before doing averages
-    merged_array = forecast_xarray_dataset.data
-    merged_array = np.delete(
-        merged_array,
-        forecast_xarray_dataset.ensemble.data.tolist().index(52),
-        axis=0,
-    )
-
-    # replace any values that went negative because of the routing
-    merged_array[merged_array <= 0] = 0
-
-    # load all the series into a dataframe
-    df = pd.DataFrame(
-        {
-            f"flow_max": np.amax(merged_array, axis=0),
-            f"flow_75p": np.nanpercentile(merged_array, 75, axis=0),
-            f"flow_avg": np.mean(merged_array, axis=0),
-            f"flow_med": np.median(merged_array, axis=0),
-            f"flow_25p": np.nanpercentile(merged_array, 25, axis=0),
-            f"flow_min": np.min(merged_array, axis=0),
-            f"high_res": forecast_xarray_dataset.sel(ensemble=52).data,
-        },
-        index=forecast_xarray_dataset.time.data,
-    )
-    df.index = df.index.strftime("%Y-%m-%dT%X+00:00")
-    df.index.name = "datetime"
+    df = get_forecast_statistics(river_id, date).loc[
+        :, ["flow_max", "flow_75p", "flow_avg", "flow_med", "flow_25p", "flow_min", "high_res"]
+    ]
+    df = _format_datetime_index(df)
     df = df.astype(np.float64).round(NUM_DECIMALS)
     if bias_corrected:
-        print("IN BIAS CORRECTED")
         df.index = pd.to_datetime(df.index)
         df = df.drop(columns=["high_res"])
-        data = geoglows.bias.sfdc_bias_correction(df, river_id).round(NUM_DECIMALS)
+        with stage("bias"):
+            data = geoglows.bias.sfdc_bias_correction(df, river_id).round(NUM_DECIMALS)
         data = data.merge(df.add_suffix("_original"), left_index=True, right_index=True, how="left")
 
         if return_format == "csv":
             return df_to_csv_flask_response(data, f"forecast_stats_{river_id}")
         if return_format == "json":
             return df_to_jsonify_response(df=data, river_id=river_id)
+        if return_format in BINARY_FORMATS:
+            return df_to_binary_flask_response(data, f"forecast_stats_{river_id}", return_format)
         return data
 
     if return_format == "csv":
-        return df_to_csv_flask_response(df, f"forecast_stats_{river_id}")
+        return df_to_csv_flask_response(df, f"forecast_stats_{_river_id_label(river_id)}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"forecast_stats_{_river_id_label(river_id)}", return_format)
     if return_format == "df":
         return df
 
 
+def get_forecast_statistics(river_id: int, date: str) -> pd.DataFrame:
+    """
+    Reads the forecast statistics for a river from the precomputed store for the date, computing them from the
+    forecast ensembles when that store has not been written
+    """
+    precomputed = get_precomputed_forecast_stats(river_id, date)
+    if precomputed is not None:
+        stats = {column: precomputed[column].transpose("time", ...).values for column in FORECAST_STATISTICS_COLUMNS}
+        times = precomputed.time.data
+    else:
+        forecast_xarray_dataset = get_forecast_dataset(river_id, date).transpose("ensemble", "time", ...)
+        with stage("compute"):
+            stats = forecast_statistics(forecast_xarray_dataset.values, forecast_xarray_dataset.ensemble.data)
+        times = forecast_xarray_dataset.time.data
+
+    if isinstance(river_id, list):
+        # one row per river per time step, river major, with the statistics arrays shaped (time, rivid)
+        return pd.DataFrame(
+            {column: values.T.ravel() for column, values in stats.items()},
+            index=pd.MultiIndex.from_product([river_id, times], names=["river_id", "datetime"]),
+        )
+    return pd.DataFrame(stats, index=times)
+
+
 def forecast_ensemble(river_id: int, date: str, return_format: str, bias_corrected: bool = False):
     forecast_xarray_dataset = get_forecast_dataset(river_id, date)
 
@@ -192,34 +242,66 @@ def forecast_ensemble(river_id: int, date: str, return_format: str, bias_correct
         ensemble_column_names.append(f"ensemble_{i:02}")
 
     # make the data into a pandas dataframe
-    df = pd.DataFrame(
-        data=np.transpose(forecast_xarray_dataset.data).round(NUM_DECIMALS),
-        columns=ensemble_column_names,
-        index=forecast_xarray_dataset.time.data,
-    )
-    df.index = df.index.strftime("%Y-%m-%dT%X+00:00")
-    df.index.name = "datetime"
+    if isinstance(river_id, list):
+        # one row per river per time step, river major
+        ensembles = forecast_xarray_dataset.transpose("rivid", "time", "ensemble").values
+        df = pd.DataFrame(
+            data=ensembles.reshape(-1, ensembles.shape[-1]),
+            columns=ensemble_column_names,
+            index=pd.MultiIndex.from_product(
+                [river_id, forecast_xarray_dataset.time.data], names=["river_id", "datetime"]
+            ),
+        )
+    else:
+        df = pd.DataFrame(
+            data=np.transpose(forecast_xarray_dataset.values).round(NUM_DECIMALS),
+            columns=ensemble_column_names,
+            index=forecast_xarray_dataset.time.data,
+        )
+    df = _format_datetime_index(df)
     df = df.astype(np.float64).round(NUM_DECIMALS)
     if bias_corrected:
         df.index = pd.to_datetime(df.index)
         df = df.drop(columns=["ensemble_52"])
-        data = geoglows.bias.sfdc_bias_correction(df, river_id).round(NUM_DECIMALS)
+        with stage("bias"):
+            data = geoglows.bias.sfdc_bias_correction(df, river_id).round(NUM_DECIMALS)
         data = data.merge(df.add_suffix("_original"), left_index=True, right_index=True, how="left")
 
         if return_format == "csv":
             return df_to_csv_flask_response(data, f"forecast_ensemble_{river_id}")
         if return_format == "json":
             return df_to_jsonify_response(df=data, river_id=river_id)
+        if return_format in BINARY_FORMATS:
+            return df_to_binary_flask_response(data, f"forecast_ensemble_{river_id}", return_format)
         return data
 
     if return_format == "csv":
-        return df_to_csv_flask_response(df, f"forecast_ensemble_{river_id}")
+        return df_to_csv_flask_response(df, f"forecast_ensemble_{_river_id_label(river_id)}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"forecast_ensemble_{_river_id_label(river_id)}", return_format)
     if return_format == "df":
         return df
 
 
+def _format_datetime_index(df: pd.DataFrame) -> pd.DataFrame:
+    if isinstance(df.index, pd.MultiIndex):
+        df.index = df.index.set_levels(
+            df.index.levels[1].strftime("%Y-%m-%dT%X+00:00"), level="datetime"
+        )
+        return df
+    df.index = df.index.strftime("%Y-%m-%dT%X+00:00")
+    df.index.name = "datetime"
+    return df
+
+
+def _river_id_label(river_id: int | list) -> str:
+    if isinstance(river_id, list):
+        return "multiple_rivers"
+    return str(river_id)
+
+
 def forecast_records(
     river_id: int, start_date: str, end_date: str, return_format: str
 ) -> pd.DataFrame:
@@ -228,35 +310,17 @@ def forecast_records(
         start_date = start_date.strftime("%Y%m%d")
     if end_date is None:
         end_date = f"{datetime.now().year + 1}0101"
-    year = start_date[:4]
 
     try:
         start_date = pd.to_datetime(start_date)
         end_date = pd.to_datetime(end_date)
     except ValueError:
-        ValueError(
+        raise ValueError(
             f"Unrecognized date format for the start_date or end_date. Use YYYYMMDD format."
         )
 
-    metadata_table = pd.read_parquet(
-        PACKAGE_METADATA_TABLE_PATH, columns=["LINKNO", "VPUCode"]
-    )
-    vpu = metadata_table.loc[
-        lambda x: x["LINKNO"] == river_id, "VPUCode"
-    ].values[0]
-    ds = get_forecast_records_dataset(vpu=vpu, year=year)
-
-    # create a dataframe and filter by date
-    df = (
-        ds.sel(rivid=river_id)
-        .Qout.to_dataframe()
-        .loc[start_date:end_date]
-        .dropna()
-        .pivot(columns="rivid", values="Qout")
-    )
-    df.columns = [
-        "average_flow",
-    ]
+    vpu = get_vpu(river_id)
+    df = get_forecast_records(river_id, vpu, start_date, end_date).to_frame("average_flow")
     df["average_flow"] = df["average_flow"].astype(float).round(NUM_DECIMALS)
     df.index = df.index.strftime("%Y-%m-%dT%X+00:00")
     df.index.name = "datetime"
@@ -266,6 +330,8 @@ def forecast_records(
         return df_to_csv_flask_response(df, f"forecast_records_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"forecast_records_{river_id}", return_format)
     if return_format == "df":
         return df
 
@@ -285,6 +351,10 @@ def forecast_dates(return_format: str):
         )
     elif return_format == "json":
         return jsonify({"dates": dates})
+    elif return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(
+            pd.DataFrame(dates, columns=["dates"]), "forecast_dates", return_format, index=False
+        )
     else:
         raise ValueError(
             f"Unsupported return format requested: {return_format}"
@@ -1,18 +1,20 @@
 import datetime
 import json
 
-import geoglows
 import pandas as pd
-from flask import jsonify
 
 import numpy as np
-import math
 
 import xarray as xr
 
+from .metrics import stage
+from .retro_cache import get_retrospective, get_bias_corrected_retrospective
 from .response_formatters import (
+    BINARY_FORMATS,
+    df_to_binary_flask_response,
     df_to_csv_flask_response,
     df_to_jsonify_response,
+    dict_to_json_response,
 )
 
 __all__ = [
@@ -23,18 +25,20 @@ __all__ = [
     "return_periods",
 ]
 
-def gumbel1(rp: int, xbar: float, std: float) -> float:
+def gumbel1(rp, xbar, std):
     """
-    Solves the Gumbel Type 1 distribution
+    Solves the Gumbel Type 1 distribution. Arguments broadcast like numpy arrays so every return period of many series
+    can be solved in one call, e.g. rp with shape (n_return_periods, 1) and xbar and std with shape (n_series,)
     Args:
         rp: return period (years)
         xbar: average of the dataset
         std: standard deviation of the dataset
 
     Returns:
-        float: solution to gumbel distribution
+        solution to gumbel distribution
     """
-    return round(-math.log(-math.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std), 2)
+    rp = np.asarray(rp, dtype=np.float64)
+    return np.round(-np.log(-np.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std), 2)
 
 def retrospective_daily(
     river_id: int,
@@ -47,11 +51,9 @@ def retrospective_daily(
     Controller for retrieving simulated historic data
     """
     if bias_corrected:
-        sim_data = geoglows.data.retro_daily(river_id, skip_log=True)
-        df = geoglows.bias.sfdc_bias_correction(sim_data, river_id)
-        df[f"{river_id}_original"] = sim_data[river_id]
+        df = get_bias_corrected_retrospective(river_id)
     else:
-        df = geoglows.data.retro_daily(river_id, skip_log=True)
+        df = get_retrospective('retro_daily', river_id)
     df.columns = df.columns.astype(str)
     df = df.astype(float).round(2)
 
@@ -67,6 +69,8 @@ def retrospective_daily(
         return df_to_csv_flask_response(df, f"retrospective_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"retrospective_{river_id}", return_format)
     return df
 
 def retrospective_hourly(
@@ -78,7 +82,7 @@ def retrospective_hourly(
     """
     Controller for retrieving simulated historic data
     """
-    df = geoglows.data.retro_hourly(river_id, skip_log=True)
+    df = get_retrospective('retro_hourly', river_id)
     df.columns = df.columns.astype(str)
     df = df.astype(float).round(2)
 
@@ -94,6 +98,8 @@ def retrospective_hourly(
         return df_to_csv_flask_response(df, f"retrospective_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"retrospective_{river_id}", return_format)
     return df
 
 def retrospective_monthly(
@@ -107,11 +113,9 @@ def retrospective_monthly(
     Controller for retrieving simulated historic data
     """
     if bias_corrected:
-        sim_data = geoglows.data.retro_daily(river_id, skip_log=True)
-        df = geoglows.bias.sfdc_bias_correction(sim_data, river_id).resample("MS").mean()
-        df[f"{river_id}_original"] = sim_data[river_id].resample("MS").mean()
+        df = get_bias_corrected_retrospective(river_id).resample("MS").mean()
     else:
-        df = geoglows.data.retro_monthly(river_id, skip_log=True)
+        df = get_retrospective('retro_monthly', river_id)
     df.columns = df.columns.astype(str)
     df = df.astype(float).round(2)
 
@@ -127,34 +131,36 @@ def retrospective_monthly(
         return df_to_csv_flask_response(df, f"retrospective_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"retrospective_{river_id}", return_format)
     return df
 
 
 def daily_averages(river_id: int, return_format: str, bias_corrected: bool = False):
     if bias_corrected:
-        sim_data = geoglows.data.retro_daily(river_id, skip_log=True)
-        data = geoglows.bias.sfdc_bias_correction(sim_data, river_id)
-        data[f"{river_id}_original"] = sim_data[river_id]
+        data = get_bias_corrected_retrospective(river_id)
     else:
-        data = geoglows.data.retro_daily(river_id)
-    df = data.groupby([data.index.month, data.index.day]).mean()
+        data = get_retrospective('retro_daily', river_id)
+    with stage("compute"):
+        df = data.groupby([data.index.month, data.index.day]).mean()
     df.index = df.index.map(lambda x: f"{x[0]:02d}-{x[1]:02d}")
     df.columns = df.columns.astype(str)
     if return_format == "csv":
         return df_to_csv_flask_response(df, f"daily_averages_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"daily_averages_{river_id}", return_format)
     return df
 
 
 def monthly_averages(river_id: int, return_format: str, bias_corrected: bool = False):
     if bias_corrected:
-        sim_data = geoglows.data.retro_daily(river_id, skip_log=True)
-        data = geoglows.bias.sfdc_bias_correction(sim_data, river_id).resample("MS").mean()
-        data[f"{river_id}_original"] = sim_data[river_id].resample("MS").mean()
+        data = get_bias_corrected_retrospective(river_id).resample("MS").mean()
     else:
-        data = geoglows.data.retro_monthly(river_id)
-    df = data.groupby(data.index.month).mean()
+        data = get_retrospective('retro_monthly', river_id)
+    with stage("compute"):
+        df = data.groupby(data.index.month).mean()
     df.columns = df.columns.astype(str)
     df = df.astype(float).round(2)
 
@@ -162,16 +168,16 @@ def monthly_averages(river_id: int, return_format: str, bias_corrected: bool = F
         return df_to_csv_flask_response(df, f"monthly_averages_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"monthly_averages_{river_id}", return_format)
     return df
 
 
 def yearly_averages(river_id, return_format, bias_corrected: bool = False):
     if bias_corrected:
-        sim_data = geoglows.data.retro_daily(river_id, skip_log=True)
-        df = geoglows.bias.sfdc_bias_correction(sim_data, river_id).resample("YS").mean()
-        df[f"{river_id}_original"] = sim_data[river_id].resample("YS").mean()
+        df = get_bias_corrected_retrospective(river_id).resample("YS").mean()
     else:
-        df = geoglows.data.retro_yearly(river_id)
+        df = get_retrospective('retro_yearly', river_id)
     df.columns = df.columns.astype(str)
     df = df.astype(float).round(2)
 
@@ -179,32 +185,35 @@ def yearly_averages(river_id, return_format, bias_corrected: bool = False):
         return df_to_csv_flask_response(df, f"yearly_averages_{river_id}")
     if return_format == "json":
         return df_to_jsonify_response(df=df, river_id=river_id)
+    if return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"yearly_averages_{river_id}", return_format)
     return df
 
 
 def return_periods(river_id: int, return_format: str, bias_corrected: bool = False):
     if bias_corrected:
-        sim_data = geoglows.data.retro_daily(river_id)
-        df = geoglows.bias.sfdc_bias_correction(sim_data = sim_data, river_id=river_id)
-        rps = [2, 5, 10, 25, 50, 100]
-        results = []
-        df = df.rename(columns={str(river_id): 'return_periods'})
-        df['return_periods_original'] = sim_data[river_id]
-        for column in ["return_periods_original", "return_periods"]:
-            annual_max_flow_list = df.groupby(df.index.strftime('%Y'))[column].max().values.flatten()
-            xbar = np.mean(annual_max_flow_list)
-            std = np.std(annual_max_flow_list)
-
-            # Compute return periods
-            ret_pers = {'Data Type': column, 'max_simulated': round(np.max(annual_max_flow_list), 2)}
-            ret_pers.update({f'{rp}': round(gumbel1(rp, xbar, std), 2) for rp in rps})
-            
-            results.append(ret_pers)
-        df = (pd.DataFrame(results).set_index("Data Type")).transpose()
+        rps = np.array([2, 5, 10, 25, 50, 100])
+        columns = ["return_periods_original", "return_periods"]
+        annual_maxima = (
+            get_retrospective('retro_annual_max_bias_corrected', river_id)
+            .rename(columns={str(river_id): 'return_periods', f"{river_id}_original": 'return_periods_original'})
+            .loc[:, columns]
+            .values
+        )
+        xbar = np.mean(annual_maxima, axis=0)
+        std = np.std(annual_maxima, axis=0)
+
+        # Compute return periods for both series at once, one row per return period
+        with stage("compute"):
+            df = pd.DataFrame(
+                np.vstack([np.round(np.max(annual_maxima, axis=0), 2), gumbel1(rps[:, np.newaxis], xbar, std)]),
+                index=['max_simulated', *[f'{rp}' for rp in rps]],
+                columns=pd.Index(columns, name="Data Type"),
+            )
         df.columns = df.columns.astype(str)
         df = df.astype(float).round(2)
         if return_format == "json":
-            return jsonify(
+            return dict_to_json_response(
                 {
                     "return_periods_original": df["return_periods_original"].to_dict(),
                     "return_periods": df["return_periods"].to_dict(),
@@ -220,11 +229,11 @@ def return_periods(river_id: int, return_format: str, bias_corrected: bool = Fal
                 }
             )
     else:
-        df =  geoglows.data.return_periods(river_id)
+        df =  get_retrospective('return_periods', river_id)
         df.columns = df.columns.astype(str)
         df = df.astype(float).round(2)
         if return_format == "json":
-            return jsonify(
+            return dict_to_json_response(
                 {
                     "return_periods": df.squeeze().to_dict(),
                     "river_id": river_id,
@@ -242,3 +251,5 @@ def return_periods(river_id: int, return_format: str, bias_corrected: bool = Fal
         return df
     elif return_format == "csv":
         return df_to_csv_flask_response(df, f"return_periods_{river_id}")
+    elif return_format in BINARY_FORMATS:
+        return df_to_binary_flask_response(df, f"return_periods_{river_id}", return_format)
@@ -1,6 +1,6 @@
 from flask import jsonify
-from .constants import PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH
-import pandas as pd
+
+from .data import latlon_to_river_id
 
 __all__ = [
     'get_river_id',
@@ -11,7 +11,6 @@ def get_river_id(lat: float, lon: float):
     Finds the river ID nearest to a given lat/lon
     Uses the ModelMasterTable to find the locations
     """
-    df = pd.read_parquet(PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH, columns=['LINKNO', 'lat', 'lon'])
-    df['dist'] = ((df['lat'] - float(lat)) ** 2 + (df['lon'] - float(lon)) ** 2) ** 0.5
-    river_id = df.loc[lambda x: x['dist'] == df['dist'].min(), 'LINKNO'].values[0]
-    return jsonify(dict(river_id=int(river_id)))
+    if lat is None or lon is None:
+        raise ValueError('you must specify both a lat and lon to find a river ID')
+    return jsonify(dict(river_id=latlon_to_river_id(lat, lon)))
@@ -1,65 +1,433 @@
 import os
+import threading
+from collections import OrderedDict
 from glob import glob
 
+import dask.array  # noqa: F401
 import natsort
+import netCDF4  # noqa: F401
+import numpy as np
+import pandas as pd
 import xarray as xr
+import zarr
+from scipy.spatial import cKDTree
+from xarray.namedarray.parallelcompat import list_chunkmanagers
 
-from .constants import PATH_TO_FORECASTS, PATH_TO_FORECAST_RECORDS
+from .constants import (
+    PATH_TO_FORECASTS,
+    PATH_TO_FORECAST_RECORDS,
+    FORECAST_DATASET_CACHE_SIZE,
+    FORECAST_RECORDS_CACHE_SIZE,
+    PACKAGE_METADATA_TABLE_PATH,
+    PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH,
+    METADATA_ARRAYS_DIR,
+)
+from .metrics import stage, count_chunk_reads
 
 __all__ = [
     'get_forecast_dataset',
+    'open_forecast_dataset',
+    'get_precomputed_forecast_stats',
+    'get_forecast_records',
+    'resolve_forecast_date',
+    'forecast_zarr_path',
+    'forecast_stats_zarr_path',
+    'forecast_rivers_zarr_path',
+    'forecast_records_path',
     'find_available_dates',
+    'find_latest_date',
+    'get_vpu',
+    'load_vpu_index',
+    'load_river_location_index',
+    'is_valid_river_id',
+    'latlon_to_river_id',
 ]
 
+# xarray imports dask, its chunk manager and the netcdf and zarr backends the first time a dataset is opened. the
+# hydroviewer stages open the forecast zarr and the records netcdf on different threads at the same time, and a thread
+# importing a module that another thread is still initializing fails, so everything is imported now, with this module
+xr.backends.list_engines()
+list_chunkmanagers()
 
-def get_forecast_dataset(river_id: int, date: str) -> xr.Dataset:
+# the encoding attributes decoded when reading a variable directly from its zarr array
+CF_ENCODING_ATTRS = ('_FillValue', 'missing_value', 'scale_factor', 'add_offset')
+
+# opened forecast zarrs keyed by (date, store), most recently used last, as (xarray dataset, zarr group) pairs. forecast
+# dates are immutable once published so the dataset (and the rivid index built when it is opened) and the zarr arrays
+# read directly for river selections can be reused by every request this worker handles
+_forecast_datasets = OrderedDict()
+_forecast_datasets_lock = threading.Lock()
+
+# opened forecast records netcdfs keyed by (vpu, year), most recently used last, as (pid, mtime, dataset). the records of
+# the current year are rewritten as forecasts are added so a file is reopened when its mtime changes, and handles opened
+# by another process (the uwsgi master during warm up) are never read through after the fork
+_forecast_records_datasets = OrderedDict()
+_forecast_records_datasets_lock = threading.Lock()
+
+# the available forecast dates, newest first. the forecast directory is only listed again when its mtime changes
+_forecast_catalog = {'mtime': None, 'dates': [], 'date_set': frozenset()}
+_forecast_catalog_lock = threading.Lock()
+
+# LINKNO -> VPUCode lookup loaded once per worker from the package metadata table, as arrays sorted by LINKNO
+_vpu_index = {}
+_vpu_index_lock = threading.Lock()
+
+# nearest neighbour index of river locations loaded once per worker from the extra metadata table
+_river_location_index = {}
+_river_location_index_lock = threading.Lock()
+
+
+def get_forecast_dataset(river_id: int, date: str) -> xr.DataArray:
+    """
+    Reads the Qout of the river_id, or list of river_ids, from the forecast dataset for a given date
+    """
+    key, path = _forecast_store(date)
+    store = 'river-major' if key[1] == 'rivers' else 'forecast'
+    return _select_rivers(key, path, ['Qout'], river_id, store).Qout
+
+
+def open_forecast_dataset(date: str) -> xr.Dataset:
     """
-    Opens the forecast dataset for a given date, selects the river_id and Qout variable
+    Returns the opened forecast dataset for a date from the per-worker cache, opening it on a cache miss. The river-major
+    copy written by rechunk_forecast is read instead of the published forecast when it exists.
+    """
+    return _open_cached_store(*_forecast_store(date))[0]
+
+
+def get_precomputed_forecast_stats(river_id: int, date: str) -> xr.Dataset | None:
+    """
+    Reads the river_id from the precomputed forecast statistics store for a date. Returns None if the store has not
+    been written for that date so the caller can compute the statistics from the forecast dataset instead
+    """
+    date = resolve_forecast_date(date)
+    stats_file = forecast_stats_zarr_path(date)
+    if not os.path.exists(stats_file):
+        return None
+    stats_dataset = _open_cached_store((date, 'stats'), stats_file)[0]
+    return _select_rivers((date, 'stats'), stats_file, list(stats_dataset.data_vars), river_id, 'stats')
+
+
+def resolve_forecast_date(date: str) -> str:
+    """
+    Converts a requested date (latest, YYYYMMDD or YYYYMMDDHH) to the YYYYMMDDHH name of a forecast zarr
     """
     if date == "latest":
-        date = find_available_dates()[0]
+        date = find_latest_date()
+    else:
+        find_available_dates()  # refreshes the catalog, evicting cached datasets for dates that were removed
 
     if len(date) == 8:
         date = f"{date}00"
+    return date
+
+
+def forecast_zarr_path(date: str) -> str:
+    return os.path.join(PATH_TO_FORECASTS, f'Qout_{date}.zarr')
+    # return os.path.join(PATH_TO_FORECASTS, f'{date}.zarr')
+
+
+def forecast_stats_zarr_path(date: str) -> str:
+    return os.path.join(PATH_TO_FORECASTS, f'forecaststats_{date}.zarr')
 
-    forecast_file = os.path.join(PATH_TO_FORECASTS, f'Qout_{date}.zarr')
-    #forecast_file = os.path.join(PATH_TO_FORECASTS, f'{date}.zarr')
-    
+
+def forecast_rivers_zarr_path(date: str) -> str:
+    return os.path.join(PATH_TO_FORECASTS, f'forecastrivers_{date}.zarr')
+
+
+def forecast_records_path(vpu, year) -> str:
+    return os.path.join(PATH_TO_FORECAST_RECORDS, f'forecastrecord_{vpu}_{year}.nc')
+
+
+def _forecast_store(date: str) -> tuple:
+    # the cache key and path of the forecast zarr read for a date
+    date = resolve_forecast_date(date)
+    rivers_file = forecast_rivers_zarr_path(date)
+    if os.path.exists(rivers_file):
+        return (date, 'rivers'), rivers_file
+    forecast_file = forecast_zarr_path(date)
     if not os.path.exists(forecast_file):
         raise ValueError(f'Data not found for date {date}. Use YYYYMMDD format and the AvailableDates endpoint.')
+    return (date, 'forecast'), forecast_file
+
+
+@stage('open')
+def _open_cached_store(key: tuple, path: str) -> tuple:
+    """
+    Returns the (xarray dataset, zarr group) pair of a zarr store from the per-worker cache, opening both on a cache miss
+    """
+    with _forecast_datasets_lock:
+        if key in _forecast_datasets:
+            _forecast_datasets.move_to_end(key)
+            return _forecast_datasets[key]
+
     try:
-        forecast_dataset = xr.open_zarr(forecast_file)
+        dataset = xr.open_zarr(path)
+        # build the rivid index now so it is kept with the cached dataset instead of on the first selection
+        dataset.indexes['rivid']
+        group = zarr.open_group(path, mode='r')
     except Exception as e:
         print(e)
         raise ValueError('Error while reading data from the zarr files')
+
+    with _forecast_datasets_lock:
+        _forecast_datasets[key] = (dataset, group)
+        _forecast_datasets.move_to_end(key)
+        while len(_forecast_datasets) > FORECAST_DATASET_CACHE_SIZE:
+            _forecast_datasets.popitem(last=False)[1][0].close()
+    return dataset, group
+
+
+@stage('select')
+def _select_rivers(key: tuple, path: str, variables: list, river_id: int | list, store: str) -> xr.Dataset:
+    """
+    Reads variables of one river, or a list of rivers, straight from the zarr arrays into a numpy backed dataset. The
+    rivid positions come from the index cached with the dataset and only the chunks holding those rivers are read,
+    without building and scheduling a dask graph for a selection of a few thousand values.
+    """
+    dataset, group = _open_cached_store(key, path)
+    index = dataset.indexes['rivid']
+    many = isinstance(river_id, list)
     try:
-        return forecast_dataset.sel(rivid=river_id).Qout
+        if many:
+            positions = index.get_indexer(river_id)
+            if np.any(positions < 0):
+                raise KeyError(np.asarray(river_id)[positions < 0].tolist())
+        else:
+            positions = np.array([index.get_loc(river_id)])
     except Exception as e:
         print(e)
         raise ValueError(f'Unable to get data for river_id {river_id} in the forecast dataset')
 
+    data_vars = {}
+    coords = {'rivid': river_id}
+    for name in variables:
+        variable = dataset[name]
+        values = _read_zarr_rivers(group[name], variable.dims, positions, many)
+        dims = variable.dims if many else tuple(dim for dim in variable.dims if dim != 'rivid')
+        # apply the fill value, scale and offset xarray would have applied when reading through the dataset
+        attrs = {attr: variable.encoding[attr] for attr in CF_ENCODING_ATTRS if attr in variable.encoding}
+        data_vars[name] = xr.conventions.decode_cf_variable(name, xr.Variable(dims, values, attrs=attrs)).load()
+        for dim in dims:
+            if dim != 'rivid' and dim in dataset.coords:
+                coords[dim] = dataset[dim].values
+    _count_chunk_reads(dataset, variables, positions, store)
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def _read_zarr_rivers(array, dims: tuple, positions: np.ndarray, many: bool) -> np.ndarray:
+    if not many:
+        return array[tuple(int(positions[0]) if dim == 'rivid' else slice(None) for dim in dims)]
+    # orthogonal selections read the positions in ascending order, put them back in the requested order after
+    order = np.argsort(positions, kind='stable')
+    values = array.oindex[tuple(positions[order] if dim == 'rivid' else slice(None) for dim in dims)]
+    return np.take(values, np.argsort(order), axis=dims.index('rivid'))
+
+
+def _count_chunk_reads(dataset: xr.Dataset, variables: list, positions: np.ndarray, store: str) -> None:
+    # the zarr chunks holding the selected rivers of each variable, for the chunk reads reported with the request
+    reads = 0
+    for name in variables:
+        variable = dataset[name]
+        chunks = variable.encoding.get('chunks')
+        if chunks is None:
+            continue
+        variable_reads = 1
+        for dim, size in zip(variable.dims, chunks):
+            if dim == 'rivid':
+                variable_reads *= np.unique(positions // size).size
+            else:
+                variable_reads *= -(-variable.sizes[dim] // size)
+        reads += variable_reads
+    count_chunk_reads(store, reads)
+
+
+def _evict_unavailable_dates(available_dates: frozenset) -> None:
+    with _forecast_datasets_lock:
+        for key in list(_forecast_datasets.keys()):
+            if key[0] not in available_dates:
+                _forecast_datasets.pop(key)[0].close()
+
 
-def get_forecast_records_dataset(vpu: str, year: str):
+def get_forecast_records(river_id: int, vpu: str, start_date: pd.Timestamp, end_date: pd.Timestamp) -> pd.Series:
     """
-    Opens the forecast records dataset for a given date, selects the river_id and Qout variable
+    Reads the forecast records of a river between two datetimes, inclusive, from the records file of every year in the
+    range. Years without a records file are skipped. Raises a ValueError if no records fall in the range.
     """
-    forecast_records_file = os.path.join(PATH_TO_FORECAST_RECORDS, f'forecastrecord_{vpu}_{year}.nc')
+    records = []
+    for year in range(start_date.year, end_date.year + 1):
+        if not os.path.exists(forecast_records_path(vpu, year)):
+            continue
+        records.append(_select_records(get_forecast_records_dataset(vpu, year), river_id, start_date, end_date))
+    if not records:
+        raise ValueError(
+            f'Data not found for specified. Use YYYYMMDD format and the Dates endpoint to find valid dates.')
+    records = pd.concat(records).dropna()
+    if records.empty:
+        raise ValueError('no forecast records are available for the requested dates')
+    return records
+
+
+@stage('select')
+def _select_records(dataset: xr.Dataset, river_id: int, start_date: pd.Timestamp, end_date: pd.Timestamp) -> pd.Series:
+    # reads only the time steps of the river in the range, by position, from the netcdf
+    try:
+        position = dataset.indexes['rivid'].get_loc(river_id)
+    except KeyError:
+        raise ValueError(f'Unable to get data for river_id {river_id} in the forecast records')
+    times = dataset.indexes['time']
+    first = times.searchsorted(start_date, side='left')
+    last = times.searchsorted(end_date, side='right')
+    qout = dataset.Qout.isel(rivid=position, time=slice(first, last)).values
+    return pd.Series(qout, index=times[first:last])
+
 
-    if not os.path.exists(forecast_records_file):
+@stage('open')
+def get_forecast_records_dataset(vpu: str, year: int | str) -> xr.Dataset:
+    """
+    Returns the opened forecast records dataset for a vpu and year from the per-worker cache, opening it on a cache miss
+    or when the file was rewritten after it was opened
+    """
+    forecast_records_file = forecast_records_path(vpu, year)
+    try:
+        mtime = os.stat(forecast_records_file).st_mtime_ns
+    except FileNotFoundError:
         raise ValueError(
             f'Data not found for specified. Use YYYYMMDD format and the Dates endpoint to find valid dates.')
+
+    key = (vpu, int(year))
+    pid = os.getpid()
+    with _forecast_records_datasets_lock:
+        entry = _forecast_records_datasets.get(key)
+        if entry is not None and entry[:2] == (pid, mtime):
+            _forecast_records_datasets.move_to_end(key)
+            return entry[2]
+
     try:
         forecast_records_dataset = xr.open_dataset(forecast_records_file)
+        # build the indexes now so they are kept with the cached dataset
+        forecast_records_dataset.indexes['rivid']
+        forecast_records_dataset.indexes['time']
     except Exception as e:
         print(e)
-        raise ValueError('Error while reading data from the zarr files')
+        raise ValueError('Error while reading data from the forecast records files')
+
+    with _forecast_records_datasets_lock:
+        stale = [_forecast_records_datasets.pop(key)] if key in _forecast_records_datasets else []
+        _forecast_records_datasets[key] = (pid, mtime, forecast_records_dataset)
+        while len(_forecast_records_datasets) > FORECAST_RECORDS_CACHE_SIZE:
+            stale.append(_forecast_records_datasets.popitem(last=False)[1])
+    for stale_pid, _, stale_dataset in stale:
+        if stale_pid == pid:
+            stale_dataset.close()
     return forecast_records_dataset
 
 
 def find_available_dates() -> list:
+    """
+    Returns the available forecast dates, newest first, from the in-memory forecast catalog
+    """
+    try:
+        mtime = os.stat(PATH_TO_FORECASTS).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    with _forecast_catalog_lock:
+        if mtime is None or mtime != _forecast_catalog['mtime']:
+            dates = _list_forecast_dates()
+            _forecast_catalog['mtime'] = mtime
+            _forecast_catalog['dates'] = dates
+            _forecast_catalog['date_set'] = frozenset(dates)
+            _evict_unavailable_dates(_forecast_catalog['date_set'])
+        return _forecast_catalog['dates']
+
+
+def find_latest_date() -> str:
+    dates = find_available_dates()
+    if not dates:
+        raise ValueError('No forecast dates are currently available')
+    return dates[0]
+
+
+def _list_forecast_dates() -> list:
     forecast_zarrs = glob(os.path.join(PATH_TO_FORECASTS, "Qout*.zarr"))
     # forecast_zarrs = glob(os.path.join(PATH_TO_FORECASTS, "*.zarr"))
     forecast_zarrs = natsort.natsorted(forecast_zarrs, reverse=True)
     dates = [os.path.basename(d).replace('.zarr', '').split('_')[1] for d in forecast_zarrs]
     # dates = [os.path.basename(d).replace('.zarr', '') for d in forecast_zarrs]
     return dates
+
+
+def get_vpu(river_id: int):
+    """
+    Returns the VPU code containing the river_id
+    """
+    linknos, vpus = load_vpu_index()
+    position = np.searchsorted(linknos, river_id)
+    if position >= linknos.size or linknos[position] != river_id:
+        raise ValueError(f'river_id {river_id} was not found in the list of valid river IDs')
+    return vpus[position]
+
+
+def is_valid_river_id(river_id: int) -> bool:
+    linknos, _ = load_vpu_index()
+    position = np.searchsorted(linknos, river_id)
+    return bool(position < linknos.size and linknos[position] == river_id)
+
+
+def load_vpu_index() -> tuple:
+    """
+    Returns the LINKNOs, sorted, and the VPU code of each, loading them the first time they are needed in this process
+    """
+    with _vpu_index_lock:
+        if not _vpu_index:
+            linkno, vpu = _load_metadata_columns('package', ["LINKNO", "VPUCode"])
+            # the memory mapped arrays are already sorted, the parquet table might not be
+            if not np.all(linkno[:-1] <= linkno[1:]):
+                order = np.argsort(linkno, kind="stable")
+                linkno, vpu = linkno[order], vpu[order]
+            _vpu_index['linkno'] = linkno
+            _vpu_index['vpu'] = vpu
+        return _vpu_index['linkno'], _vpu_index['vpu']
+
+
+def _load_metadata_columns(table: str, columns: list) -> list:
+    """
+    Memory maps the columns of a metadata table written by build_metadata_arrays so every worker shares the same pages,
+    or reads them from the parquet table if the arrays have not been built
+    """
+    paths = [os.path.join(METADATA_ARRAYS_DIR, f'{table}_{column}.npy') for column in columns]
+    if all(os.path.exists(path) for path in paths):
+        return [np.load(path, mmap_mode='r') for path in paths]
+    table_path = PACKAGE_METADATA_TABLE_PATH if table == 'package' else PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH
+    df = pd.read_parquet(table_path, columns=columns)
+    return [df[column].values for column in columns]
+
+
+def latlon_to_river_id(lat: float, lon: float) -> int:
+    """
+    Returns the LINKNO of the river whose location is nearest, by great circle distance, to a lat/lon
+    """
+    tree, linknos = load_river_location_index()
+    _, position = tree.query(_latlon_to_unit_vectors(np.array([float(lat)]), np.array([float(lon)]))[0])
+    return int(linknos[position])
+
+
+def load_river_location_index() -> tuple:
+    """
+    Returns the KD-tree of the river locations and the LINKNO of each, building it the first time it is needed in this
+    process
+    """
+    with _river_location_index_lock:
+        if not _river_location_index:
+            linkno, lat, lon = _load_metadata_columns('extra', ['LINKNO', 'lat', 'lon'])
+            _river_location_index['tree'] = cKDTree(_latlon_to_unit_vectors(lat, lon))
+            _river_location_index['linkno'] = linkno
+        return _river_location_index['tree'], _river_location_index['linkno']
+
+
+def _latlon_to_unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    # the straight line distance between points on the unit sphere increases with their great circle distance so the
+    # nearest neighbour by euclidean distance in 3D is also the nearest along the surface of the earth
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
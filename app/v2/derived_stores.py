@@ -0,0 +1,80 @@
+"""
+Shared by the tools that write stores derived from a published Qout_<date>.zarr next to it (precompute_forecast_stats
+and rechunk_forecast). Each tool is run after a new forecast is published, from the directory that contains the v2
+package (/app), and takes the same arguments:
+
+    python -m v2.<tool>              # the latest forecast date
+    python -m v2.<tool> 2024010100   # specific dates
+    python -m v2.<tool> --missing    # every available date that does not have a store yet
+"""
+import argparse
+import os
+import shutil
+from typing import Callable, Iterable
+
+import xarray as xr
+
+from .data import find_available_dates
+
+__all__ = [
+    'write_store_atomically',
+    'run_store_cli',
+]
+
+
+def write_store_atomically(path: str, blocks: Iterable[xr.Dataset], rivers_per_chunk: int,
+                           variable_encoding: dict = None, overwrite: bool = False, **to_zarr_kwargs) -> str:
+    """
+    Writes datasets that are consecutive blocks of rivers to a zarr store, appending each block after the first along
+    rivid. Every variable with a rivid dimension is chunked rivers_per_chunk rivers at a time and whole along its other
+    dimensions, with the variable_encoding (e.g. a compressor) added to its encoding. The store is written to a
+    temporary path then renamed so the API never reads a partially written store. An existing store is kept, without
+    reading any block, unless overwrite is set.
+
+    Returns:
+        str: path to the store
+    """
+    if os.path.exists(path) and not overwrite:
+        return path
+
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    for i, block in enumerate(blocks):
+        if i == 0:
+            encoding = {
+                name: {
+                    'chunks': tuple(rivers_per_chunk if dim == 'rivid' else block.sizes[dim] for dim in variable.dims),
+                    **(variable_encoding or {}),
+                }
+                for name, variable in block.data_vars.items() if 'rivid' in variable.dims
+            }
+            block.to_zarr(tmp_path, mode='w', encoding=encoding, consolidated=True, **to_zarr_kwargs)
+        else:
+            block.to_zarr(tmp_path, append_dim='rivid', consolidated=True, **to_zarr_kwargs)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return path
+
+
+def run_store_cli(description: str, write_store: Callable, options: dict) -> None:
+    """
+    Parses the command line of a derived store tool and writes the store of each requested date
+
+    Args:
+        description: what the tool does, shown by --help
+        write_store: called with a date, overwrite and the value of each option by its keyword, returns the store path
+        options: integer options of the tool as {flag: (keyword, default, help)}
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('dates', nargs='*', default=['latest'], help='YYYYMMDD or YYYYMMDDHH dates, default latest')
+    parser.add_argument('--missing', action='store_true', help='process every available date without a store')
+    parser.add_argument('--overwrite', action='store_true', help='rewrite stores that already exist')
+    for flag, (keyword, default, help_text) in options.items():
+        parser.add_argument(flag, dest=keyword, type=int, default=default, help=help_text)
+    args = parser.parse_args()
+
+    dates = find_available_dates() if args.missing else args.dates
+    for date in dates:
+        print(write_store(date, overwrite=args.overwrite, **{keyword: getattr(args, keyword) for keyword, *_ in
+                                                             options.values()}))
@@ -0,0 +1,138 @@
+import os
+import stat
+import threading
+import uuid
+
+from .metrics import count_cache_event
+
+__all__ = [
+    'DiskLRUCache',
+]
+
+
+class DiskLRUCache:
+    """
+    A size bounded cache of files in a directory that every worker process on the node shares. Each entry is written to
+    a unique temporary file and renamed into place so readers never see a partial entry. A file's mtime is refreshed
+    each time it is read and the least recently read files are deleted once the directory grows past max_bytes.
+
+    The entries may be unpickled by the caller, so the directory is created readable and writable only by the user the
+    app runs as. The cache is not used if the directory belongs to another user or others can write to it.
+
+    Args:
+        directory: where the cache files are kept
+        max_bytes: the size the cache is trimmed back to when it is exceeded
+        evict_every: check the size of the cache after this many writes by this process
+        name: the cache label of the counts exported as metrics
+    """
+
+    def __init__(self, directory: str, max_bytes: int, evict_every: int = 1, name: str = 'disk'):
+        self.directory = directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.counts = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'bytes_read': 0, 'bytes_written': 0}
+        self._lock = threading.Lock()
+        self._usable = None
+
+    def read(self, key: str) -> bytes | None:
+        """
+        Returns the bytes stored for a key, or None on a miss
+        """
+        if not self.usable():
+            self._count('misses')
+            return None
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._count('misses')
+            return None
+        self._count('hits')
+        self._count('bytes_read', len(data))
+        return data
+
+    def write(self, key: str, data: bytes) -> None:
+        if not self.usable():
+            return
+        path = self.path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._count('bytes_written', len(data))
+        self._count('writes')
+        if self.counts['writes'] % self.evict_every == 0:
+            self.evict()
+
+    def usable(self) -> bool:
+        """
+        Creates the cache directory the first time it is used and checks that only this user can write to it
+        """
+        if self._usable is None:
+            self._usable = self._secure_directory()
+            if not self._usable:
+                print(f'{self.name} cache disabled: {self.directory} must be a directory owned by uid {os.getuid()}')
+        return self._usable
+
+    def _secure_directory(self) -> bool:
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            # lstat so a symlink planted in place of the directory is rejected rather than followed
+            directory_stat = os.lstat(self.directory)
+            if not stat.S_ISDIR(directory_stat.st_mode) or directory_stat.st_uid != os.getuid():
+                return False
+            if directory_stat.st_mode & 0o077:
+                os.chmod(self.directory, 0o700)
+        except OSError:
+            return False
+        return True
+
+    def remove(self, key: str) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def evict(self) -> None:
+        if not self.usable():
+            return
+        files = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._count('evictions')
+            except FileNotFoundError:
+                pass  # another worker evicted it first
+            total_size -= size
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[key] += n
+        count_cache_event(self.name, key, n)
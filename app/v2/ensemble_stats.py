@@ -0,0 +1,99 @@
+import numpy as np
+
+__all__ = [
+    'ensemble_statistics',
+    'forecast_statistics',
+    'FORECAST_STATISTICS_COLUMNS',
+]
+
+SUMMARY_STATISTICS = ('max', 'min', 'mean', 'median')
+HIGH_RES_ENSEMBLE = 52
+FORECAST_STATISTICS_COLUMNS = (
+    'flow_max', 'flow_80p', 'flow_75p', 'flow_avg', 'flow_med', 'flow_25p', 'flow_20p', 'flow_min', 'high_res',
+)
+
+
+def ensemble_statistics(ensembles: np.ndarray, quantiles: list = (), statistics: list = SUMMARY_STATISTICS) -> dict:
+    """
+    Computes quantiles and summary statistics across the ensemble members (axis 0) from a single sort of the array
+
+    Args:
+        ensembles: array with the ensemble members on the first axis, e.g. (ensemble, time) or (ensemble, time, rivid)
+        quantiles: percentiles between 0 and 100 to compute. NaN members are ignored, like np.nanpercentile
+        statistics: any of 'max', 'min', 'mean' and 'median'. These are NaN where any member is NaN, like np.amax,
+            np.min, np.mean and np.median
+
+    Returns:
+        dict: arrays with the ensemble axis removed keyed by the quantile or statistic name
+    """
+    for statistic in statistics:
+        if statistic not in SUMMARY_STATISTICS:
+            raise ValueError(f'Unsupported statistic "{statistic}". Choose from {SUMMARY_STATISTICS}')
+
+    # np.sort places NaN after every number so the valid members are the leading block along axis 0
+    ordered = np.sort(np.asarray(ensembles, dtype=np.float64), axis=0)
+    n_members = ordered.shape[0]
+    n_valid = np.count_nonzero(~np.isnan(ordered), axis=0)
+    any_nan = n_valid < n_members
+
+    results = {q: _quantile_from_sorted(ordered, n_valid, q) for q in quantiles}
+    if 'max' in statistics:
+        results['max'] = ordered[-1]
+    if 'min' in statistics:
+        results['min'] = np.where(any_nan, np.nan, ordered[0])
+    if 'mean' in statistics:
+        results['mean'] = ordered.sum(axis=0) / n_members
+    if 'median' in statistics:
+        results['median'] = np.where(any_nan, np.nan, _quantile_from_sorted(ordered, n_valid, 50))
+    return results
+
+
+def forecast_statistics(qout: np.ndarray, ensembles: list) -> dict:
+    """
+    Computes every statistic served by the forecast and forecaststats products
+
+    Args:
+        qout: flows with the ensemble members on the first axis, for one river (ensemble, time) or many rivers
+            (ensemble, time, rivid)
+        ensembles: the ensemble number of each member along the first axis. Member 52 is the high resolution run
+
+    Returns:
+        dict: arrays with the ensemble axis removed keyed by the names in FORECAST_STATISTICS_COLUMNS
+    """
+    qout = np.asarray(qout, dtype=np.float64)
+    high_res_index = list(ensembles).index(HIGH_RES_ENSEMBLE)
+
+    # delete the high res before doing averages
+    merged_array = np.delete(qout, high_res_index, axis=0)
+    # replace any values that went negative because of the routing
+    merged_array[merged_array <= 0] = 0
+
+    stats = ensemble_statistics(merged_array, quantiles=(80, 75, 25, 20))
+    return {
+        'flow_max': stats['max'],
+        'flow_80p': stats[80],
+        'flow_75p': stats[75],
+        'flow_avg': stats['mean'],
+        'flow_med': stats['median'],
+        'flow_25p': stats[25],
+        'flow_20p': stats[20],
+        'flow_min': stats['min'],
+        'high_res': qout[high_res_index],
+    }
+
+
+def _quantile_from_sorted(ordered: np.ndarray, n_valid: np.ndarray, q: float) -> np.ndarray:
+    """
+    Linearly interpolated percentile (numpy's default method) of the leading n_valid values of an array sorted on axis 0
+    """
+    if not 0 <= q <= 100:
+        raise ValueError(f'Quantiles must be between 0 and 100, got {q}')
+    position = (n_valid - 1) * (q / 100)
+    last_valid = np.maximum(n_valid - 1, 0)
+    lower = np.clip(np.floor(position).astype(np.intp), 0, last_valid)
+    upper = np.minimum(lower + 1, last_valid)
+    fraction = position - lower
+    lower_values = np.take_along_axis(ordered, lower[np.newaxis], axis=0)[0]
+    upper_values = np.take_along_axis(ordered, upper[np.newaxis], axis=0)[0]
+    result = lower_values + (upper_values - lower_values) * fraction
+    return np.where(n_valid == 0, np.nan, result)
@@ -0,0 +1,124 @@
+import datetime
+import hashlib
+import os
+from datetime import timedelta
+
+from flask import Response
+
+from .constants import (
+    CACHE_MAX_AGE_FORECAST_DATE,
+    CACHE_MAX_AGE_FORECAST_LATEST,
+    CACHE_MAX_AGE_FORECAST_RECORDS,
+    CACHE_MAX_AGE_RETROSPECTIVE,
+    CACHE_MAX_AGE_DATES,
+    PATH_TO_FORECASTS,
+    PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH,
+)
+from .data import resolve_forecast_date, forecast_zarr_path, forecast_records_path, get_vpu
+from .retro_cache import retrospective_version
+
+__all__ = [
+    'request_validator',
+    'is_not_modified',
+    'not_modified_response',
+    'add_validator_headers',
+]
+
+FORECAST_PRODUCTS = {'forecast', 'forecaststats', 'forecastensemble'}
+RETROSPECTIVE_PRODUCTS = {
+    'retrospectivehourly',
+    'retrospectivedaily',
+    'retrospectivemonthly',
+    'monthlyaverages',
+    'dailyaverages',
+    'annualaverages',
+    'returnperiods',
+}
+
+
+def request_validator(product: str, river_id, return_format: str, date: str, start_date: str, end_date: str,
+                      bias_corrected: bool, lat: str = None, lon: str = None) -> dict | None:
+    """
+    Finds the version of the data a normalized request reads without reading it: the forecast date, the forecast records
+    file mtimes or the retrospective version. Returns the ETag, Last-Modified time and max age for that version, or None
+    if the version cannot be determined and the response should not be cached. Responses that depend on the
+    retrospective version have no Last-Modified time since the version is not a time and are only validated by ETag.
+    """
+    try:
+        versions = []
+        mtimes = []
+        uses_retrospective = product in RETROSPECTIVE_PRODUCTS or product == 'hydroviewer' or bias_corrected
+        if uses_retrospective:
+            versions.append(f'retrospective-{retrospective_version()}')
+        if product in FORECAST_PRODUCTS or product == 'hydroviewer':
+            resolved_date = resolve_forecast_date(date)
+            versions.append(f'forecast-{resolved_date}')
+            mtimes.append(os.stat(forecast_zarr_path(resolved_date)).st_mtime)
+            max_age = CACHE_MAX_AGE_FORECAST_LATEST if date == 'latest' else CACHE_MAX_AGE_FORECAST_DATE
+            if product == 'hydroviewer' and start_date:
+                mtimes.append(_forecast_records_mtime(river_id, start_date, resolved_date[:8]))
+                max_age = min(max_age, CACHE_MAX_AGE_FORECAST_RECORDS)
+        elif product == 'forecastrecords':
+            mtimes.append(_forecast_records_mtime(river_id, start_date, end_date))
+            max_age = CACHE_MAX_AGE_FORECAST_RECORDS
+        elif product in RETROSPECTIVE_PRODUCTS:
+            max_age = CACHE_MAX_AGE_RETROSPECTIVE
+        elif product == 'dates':
+            mtimes.append(os.stat(PATH_TO_FORECASTS).st_mtime)
+            max_age = CACHE_MAX_AGE_DATES
+        elif product == 'getriverid':
+            mtimes.append(os.stat(PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH).st_mtime)
+            max_age = CACHE_MAX_AGE_RETROSPECTIVE
+        else:
+            return None
+    except Exception:
+        return None
+
+    last_modified = None
+    if mtimes:
+        versions.append(str(int(max(mtimes))))
+        if not uses_retrospective:
+            last_modified = datetime.datetime.fromtimestamp(int(max(mtimes)), datetime.UTC)
+    key = repr((product, river_id, return_format, date, start_date, end_date, bias_corrected, lat, lon, versions))
+    return {
+        'etag': hashlib.sha1(key.encode()).hexdigest(),
+        'last_modified': last_modified,
+        'max_age': max_age,
+    }
+
+
+def is_not_modified(request, validator: dict) -> bool:
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(validator['etag'])
+    if request.if_modified_since and validator['last_modified'] is not None:
+        return validator['last_modified'] <= request.if_modified_since
+    return False
+
+
+def not_modified_response(validator: dict) -> Response:
+    return add_validator_headers(Response(status=304), validator)
+
+
+def add_validator_headers(response: Response, validator: dict) -> Response:
+    # the json responses include the time they were generated so the etag is weak: equivalent but not byte identical
+    response.set_etag(validator['etag'], weak=True)
+    if validator['last_modified'] is not None:
+        response.last_modified = validator['last_modified']
+    response.cache_control.public = True
+    response.cache_control.max_age = validator['max_age']
+    return response
+
+
+def _forecast_records_mtime(river_id: int, start_date: str, end_date: str) -> float:
+    if start_date is None:
+        start_date = (datetime.datetime.now() - timedelta(days=14)).strftime("%Y%m%d")
+    if end_date is None:
+        end_date = f"{datetime.datetime.now().year + 1}0101"
+    vpu = get_vpu(river_id)
+    mtimes = []
+    for year in range(int(start_date[:4]), int(end_date[:4]) + 1):
+        try:
+            mtimes.append(os.stat(forecast_records_path(vpu, year)).st_mtime)
+        except FileNotFoundError:
+            continue
+    return max(mtimes)
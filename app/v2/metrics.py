@@ -0,0 +1,217 @@
+"""
+Times the stages of each v2 request for the Server-Timing header and keeps Prometheus metrics that every uwsgi worker
+writes to memory mapped files in METRICS_DIR, so the /metrics endpoint served by any one worker reports the totals of
+all of them.
+"""
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response
+
+from .constants import METRICS_DIR
+
+# prometheus_client reads PROMETHEUS_MULTIPROC_DIR when it is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', METRICS_DIR)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, values,
+)
+from prometheus_client.multiprocess import MultiProcessCollector  # noqa: E402
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+__all__ = [
+    'stage',
+    'stage_streamed',
+    'start_request_timer',
+    'finish_request_timer',
+    'count_chunk_reads',
+    'count_cache_event',
+    'count_analytics_event',
+    'metrics_response',
+]
+
+
+def _process_identifier():
+    # uwsgi respawns a recycled worker into the same slot, so keying the files by slot keeps one file per worker that
+    # carries on counting instead of adding a file for every respawn
+    if uwsgi is not None:
+        return f'uwsgi_worker_{uwsgi.worker_id()}'
+    return os.getpid()
+
+
+values.ValueClass = values.MultiProcessValue(process_identifier=_process_identifier)
+
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+CHUNK_READ_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+REQUEST_DURATION = Histogram(
+    'geoglows_request_duration_seconds', 'Seconds to answer a v2 request',
+    ['product', 'format', 'status'], buckets=DURATION_BUCKETS,
+)
+STAGE_DURATION = Histogram(
+    'geoglows_request_stage_duration_seconds', 'Seconds spent in each stage of answering a v2 request',
+    ['product', 'stage'], buckets=DURATION_BUCKETS,
+)
+CHUNK_READS = Histogram(
+    'geoglows_request_zarr_chunk_reads', 'Zarr chunks read to answer a v2 request from each kind of store',
+    ['product', 'store'], buckets=CHUNK_READ_BUCKETS,
+)
+CACHE_EVENTS = Counter(
+    'geoglows_cache_events', 'Hits, misses, writes, evictions and bytes read and written by the disk caches',
+    ['cache', 'event'],
+)
+ANALYTICS_EVENTS = Counter(
+    'geoglows_analytics_log_events', 'Request log events queued, sent, dropped and failed', ['event'],
+)
+
+_current_timer = contextvars.ContextVar('request_timer', default=None)
+
+
+class RequestTimer:
+    """
+    Seconds spent in each named stage of one request. Time in a stage nested in another is only counted for the inner
+    stage. Stages run on the hydroviewer thread pool are timed in parallel so the stages can add up to more than the
+    total.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.product = 'invalid'
+        self.return_format = 'invalid'
+        self.record = True
+        self.stages = {}
+        self.chunk_reads = {}
+        self._lock = threading.Lock()
+        self._nested = threading.local()
+
+    def nested_stack(self) -> list:
+        if not hasattr(self._nested, 'stack'):
+            self._nested.stack = []
+        return self._nested.stack
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def add_chunk_reads(self, store: str, n: int) -> None:
+        with self._lock:
+            self.chunk_reads[store] = self.chunk_reads.get(store, 0) + n
+
+    def server_timing(self, total: float) -> str:
+        with self._lock:
+            stages = list(self.stages.items())
+            chunk_reads = list(self.chunk_reads.items())
+        return ', '.join([
+            *[f'{name};dur={seconds * 1000:.1f}' for name, seconds in [*stages, ('total', total)]],
+            *[f'{store}-chunks;desc={n}' for store, n in chunk_reads],
+        ])
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times the code in the with block, or the decorated function, as a stage of the current request. Does nothing
+    outside of a timed request.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    stack = timer.nested_stack()
+    stack.append(0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        timer.add(name, elapsed - nested)
+
+
+def stage_streamed(name: str, body):
+    """
+    Wraps the iterable body of a streamed response to time producing each block as a stage of the current request.
+    The body is written after the headers are sent and the request timer has finished, so the stage is recorded in the
+    metrics once the last block is produced but is never part of the Server-Timing header.
+    """
+    timer = _current_timer.get()
+    if timer is None or not timer.record:
+        return body
+    return _timed_blocks(name, body, timer.product)
+
+
+def _timed_blocks(name: str, body, product: str):
+    seconds = 0
+    blocks = iter(body)
+    while True:
+        start = time.perf_counter()
+        try:
+            block = next(blocks)
+        except StopIteration:
+            break
+        finally:
+            seconds += time.perf_counter() - start
+        yield block
+    STAGE_DURATION.labels(product, name).observe(seconds)
+
+
+def start_request_timer() -> RequestTimer:
+    timer = RequestTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+def finish_request_timer(response: Response) -> Response:
+    """
+    Adds the Server-Timing header to the response of the current request and records its durations. The durations of
+    streamed responses do not include writing the body while it is sent.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return response
+    _current_timer.set(None)
+    total = time.perf_counter() - timer.start
+    response.headers['Server-Timing'] = timer.server_timing(total)
+    if timer.record:
+        REQUEST_DURATION.labels(timer.product, timer.return_format, str(response.status_code)).observe(total)
+        for name, seconds in timer.stages.items():
+            STAGE_DURATION.labels(timer.product, name).observe(seconds)
+        for store, n in timer.chunk_reads.items():
+            CHUNK_READS.labels(timer.product, store).observe(n)
+    return response
+
+
+def count_chunk_reads(store: str, n: int) -> None:
+    """
+    Adds to the number of zarr chunks the current request read from a kind of store
+    """
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add_chunk_reads(store, n)
+
+
+def count_cache_event(cache: str, event: str, n: int = 1) -> None:
+    CACHE_EVENTS.labels(cache, event).inc(n)
+
+
+def count_analytics_event(event: str, n: int = 1) -> None:
+    ANALYTICS_EVENTS.labels(event).inc(n)
+
+
+def metrics_response() -> Response:
+    """
+    The metrics of every worker in the Prometheus text format
+    """
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
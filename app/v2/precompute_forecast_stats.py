@@ -0,0 +1,53 @@
+"""
+Writes the precomputed forecast statistics store for forecast dates so the API can serve forecast and forecaststats
+with one small read instead of sorting the 51 ensemble members per request. See derived_stores for how to run it:
+
+    python -m v2.precompute_forecast_stats [dates] [--missing] [--overwrite] [--chunk-size N]
+"""
+import xarray as xr
+
+from .constants import FORECAST_STATS_RIVID_CHUNK_SIZE
+from .data import resolve_forecast_date, forecast_zarr_path, forecast_stats_zarr_path
+from .derived_stores import write_store_atomically, run_store_cli
+from .ensemble_stats import forecast_statistics, FORECAST_STATISTICS_COLUMNS
+
+__all__ = [
+    'write_forecast_stats_store',
+]
+
+
+def write_forecast_stats_store(date: str, chunk_size: int = FORECAST_STATS_RIVID_CHUNK_SIZE,
+                               overwrite: bool = False) -> str:
+    """
+    Computes the forecast statistics for every river in the forecast for a date and writes them to a river-major zarr
+    next to the forecast, chunk_size rivers at a time.
+
+    Returns:
+        str: path to the statistics store
+    """
+    date = resolve_forecast_date(date)
+    return write_store_atomically(forecast_stats_zarr_path(date), _stats_blocks(date, chunk_size), chunk_size,
+                                  overwrite=overwrite)
+
+
+def _stats_blocks(date: str, chunk_size: int):
+    forecast_dataset = xr.open_zarr(forecast_zarr_path(date))
+    qout = forecast_dataset.Qout.transpose('ensemble', 'time', 'rivid')
+    ensembles = forecast_dataset.ensemble.data
+    times = forecast_dataset.time.data
+    for start in range(0, forecast_dataset.rivid.size, chunk_size):
+        block = qout.isel(rivid=slice(start, start + chunk_size))
+        stats = forecast_statistics(block.values, ensembles)
+        yield xr.Dataset(
+            {column: (('rivid', 'time'), stats[column].T) for column in FORECAST_STATISTICS_COLUMNS},
+            coords={'rivid': block.rivid.data, 'time': times},
+        )
+
+
+if __name__ == '__main__':
+    run_store_cli(
+        'Precompute forecast statistics for every river on a forecast date',
+        write_forecast_stats_store,
+        {'--chunk-size': ('chunk_size', FORECAST_STATS_RIVID_CHUNK_SIZE,
+                          'number of rivers computed and stored per chunk')},
+    )
@@ -0,0 +1,64 @@
+"""
+Copies a forecast zarr into river-major chunks: blocks of FORECAST_RIVERS_PER_CHUNK rivers with every ensemble member
+and time step, Blosc LZ4 compressed and with consolidated metadata. A request for one river then reads and decompresses
+one chunk of Qout instead of a piece of every chunk that spans thousands of rivers. The API reads
+forecastrivers_<date>.zarr in place of Qout_<date>.zarr whenever it exists. See derived_stores for how to run it:
+
+    python -m v2.rechunk_forecast [dates] [--missing] [--overwrite] [--rivers-per-chunk N] [--batch-size N]
+"""
+import numcodecs
+import xarray as xr
+import zarr
+
+from .constants import FORECAST_RIVERS_PER_CHUNK
+from .data import resolve_forecast_date, forecast_zarr_path, forecast_rivers_zarr_path
+from .derived_stores import write_store_atomically, run_store_cli
+
+__all__ = [
+    'write_river_major_store',
+]
+
+# lz4 decompresses several times faster than the zstd or zlib compressors for a slightly larger store
+COMPRESSOR = numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+# zarr-python 3 takes a sequence of compressors in the encoding and zarr-python 2 a single compressor
+if int(zarr.__version__.split('.')[0]) >= 3:
+    COMPRESSOR_ENCODING = {'compressors': (COMPRESSOR,)}
+else:
+    COMPRESSOR_ENCODING = {'compressor': COMPRESSOR}
+
+# rivers read from the published forecast at once, a few hundred MB of Qout
+BATCH_SIZE = 10_240
+
+
+def write_river_major_store(date: str, rivers_per_chunk: int = FORECAST_RIVERS_PER_CHUNK,
+                            batch_size: int = BATCH_SIZE, overwrite: bool = False) -> str:
+    """
+    Copies the forecast for a date to a river-major zarr next to it, batch_size rivers at a time
+
+    Returns:
+        str: path to the river-major store
+    """
+    date = resolve_forecast_date(date)
+    # each batch writes whole chunks so no chunk is written twice
+    batch_size = max(batch_size // rivers_per_chunk, 1) * rivers_per_chunk
+    return write_store_atomically(
+        forecast_rivers_zarr_path(date), _forecast_batches(date, batch_size), rivers_per_chunk,
+        variable_encoding=COMPRESSOR_ENCODING, overwrite=overwrite, zarr_format=2,
+    )
+
+
+def _forecast_batches(date: str, batch_size: int):
+    forecast_dataset = xr.open_zarr(forecast_zarr_path(date))
+    for start in range(0, forecast_dataset.sizes['rivid'], batch_size):
+        yield forecast_dataset.isel(rivid=slice(start, start + batch_size)).load().drop_encoding()
+
+
+if __name__ == '__main__':
+    run_store_cli(
+        'Copy forecasts into river-major chunks for single river reads',
+        write_river_major_store,
+        {
+            '--rivers-per-chunk': ('rivers_per_chunk', FORECAST_RIVERS_PER_CHUNK, 'number of rivers stored per chunk'),
+            '--batch-size': ('batch_size', BATCH_SIZE, 'number of rivers copied at once'),
+        },
+    )
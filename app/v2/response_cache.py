@@ -0,0 +1,83 @@
+import json
+import os
+import time
+
+from flask import Response
+
+from .constants import RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES
+from .disk_cache import DiskLRUCache
+
+__all__ = [
+    'get_cached_response',
+    'cache_response',
+]
+
+# headers that are stored with the body. the validator and cache headers are added again to every response
+STORED_HEADERS = ('Content-Type', 'Content-Disposition')
+
+# trim the cache on every 50th write per worker since walking the cache directory costs more than one entry
+_cache = DiskLRUCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES, evict_every=50, name='response')
+
+
+def get_cached_response(etag: str) -> Response | None:
+    """
+    Returns the response stored by any worker for the request the etag was made from, or None if there is no unexpired
+    entry. The etag includes the forecast date or other dataset version so entries for "latest" stop being found as
+    soon as a new forecast is published and are evicted by the LRU.
+    """
+    if not RESPONSE_CACHE_MAX_BYTES:
+        return None
+    key = _key(etag)
+    data = _cache.read(key)
+    if data is None:
+        return None
+    metadata, body = data.split(b'\n', 1)
+    entry = json.loads(metadata)
+    if entry['expires'] < time.time():
+        _cache.remove(key)
+        return None
+    return Response(body, status=entry['status'], headers=entry['headers'])
+
+
+def cache_response(etag: str, response: Response, max_age: int) -> Response:
+    """
+    Stores a response for max_age seconds. Streamed responses are stored after the last chunk has been sent and only
+    if they were smaller than RESPONSE_CACHE_MAX_ENTRY_BYTES.
+    """
+    if not RESPONSE_CACHE_MAX_BYTES:
+        return response
+    headers = [(name, response.headers[name]) for name in STORED_HEADERS if name in response.headers]
+    expires = time.time() + max_age
+
+    if not response.is_streamed:
+        body = response.get_data()
+        if len(body) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            _store(etag, response.status_code, headers, body, expires)
+        return response
+
+    def tee(chunks):
+        buffered = []
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            if buffered is not None:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                    buffered = None
+        if buffered is not None:
+            _store(etag, response.status_code, headers, b''.join(buffered), expires)
+
+    response.response = tee(response.iter_encoded())
+    return response
+
+
+def _store(etag: str, status: int, headers: list, body: bytes, expires: float) -> None:
+    # a line of json with the status, headers and expiry followed by the raw body, nothing in the file is executed
+    metadata = json.dumps({'status': status, 'headers': headers, 'expires': expires}).encode()
+    _cache.write(_key(etag), metadata + b'\n' + body)
+
+
+def _key(etag: str) -> str:
+    # spread the entries over subdirectories so no single directory holds every file
+    return os.path.join(etag[:2], f'{etag}.response')
@@ -1,26 +1,173 @@
 import datetime
+import io
+import os
+import tempfile
 
 import numpy as np
+import orjson
 import pandas as pd
-from flask import make_response, jsonify
+import pyarrow as pa
+import xarray as xr
+from flask import Response
 
-__all__ = ['df_to_csv_flask_response', 'df_to_jsonify_response', 'new_json_template', ]
+from .constants import CSV_STREAM_BLOCK_ROWS
+from .metrics import stage, stage_streamed
+
+__all__ = [
+    'df_to_csv_flask_response',
+    'df_to_jsonify_response',
+    'df_to_binary_flask_response',
+    'dict_to_json_response',
+    'new_json_template',
+    'BINARY_FORMATS',
+]
+
+# binary return formats and their content type and file extension
+BINARY_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', 'arrow'),
+    'netcdf': ('application/x-netcdf', 'nc'),
+}
+
+# numpy arrays are written by orjson straight from their buffers and datetime64 values in the API's date format
+JSON_OPTIONS = (
+    orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_OMIT_MICROSECONDS | orjson.OPT_NON_STR_KEYS
+)
 
 
 def df_to_csv_flask_response(df: pd.DataFrame, csv_name: str, *, index: bool = True):
-    response = make_response(df.to_csv(index=index))
+    # the blocks are written while the response streams, so they are timed as they are produced
+    response = Response(stage_streamed('serialize', _iter_csv_blocks(df, index=index)), mimetype='text/csv')
     response.headers['content-type'] = 'text/csv'
     response.headers['Content-Disposition'] = f'attachment; filename={csv_name}.csv'
     return response
 
 
-def df_to_jsonify_response(df: pd.DataFrame, river_id: int):
-    if isinstance(df.index, pd.DatetimeIndex):
-        df.index = df.index.strftime('%Y-%m-%dT%X+00:00')
+def _iter_csv_blocks(df: pd.DataFrame, index: bool):
+    # stream the csv a block of rows at a time so the whole text of long series is never held in memory
+    yield df.iloc[:0].to_csv(index=index)
+    for start in range(0, len(df), CSV_STREAM_BLOCK_ROWS):
+        yield df.iloc[start:start + CSV_STREAM_BLOCK_ROWS].to_csv(index=index, header=False)
+
+
+@stage('serialize')
+def df_to_binary_flask_response(df: pd.DataFrame, file_name: str, return_format: str, *, index: bool = True):
+    if return_format not in BINARY_FORMATS:
+        raise ValueError(f'Unsupported return format requested: {return_format}')
+    content_type, extension = BINARY_FORMATS[return_format]
+    df = _restore_datetime_index(df)
+
+    if return_format == 'parquet':
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=index)
+        body = buffer.getvalue()
+    elif return_format == 'arrow':
+        table = pa.Table.from_pandas(df, preserve_index=index)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        body = sink.getvalue().to_pybytes()
+    else:
+        body = _df_to_netcdf_bytes(df if index else df.reset_index(drop=True))
+
+    response = Response(body, mimetype=content_type)
+    response.headers['Content-Disposition'] = f'attachment; filename={file_name}.{extension}'
+    return response
+
+
+def _restore_datetime_index(df: pd.DataFrame) -> pd.DataFrame:
+    # the controllers format datetime indexes as strings for csv and json, binary formats keep them as datetimes
+    if isinstance(df.index, pd.MultiIndex):
+        if 'datetime' in df.index.names and df.index.levels[df.index.names.index('datetime')].dtype == object:
+            df = df.copy(deep=False)
+            level = df.index.names.index('datetime')
+            df.index = df.index.set_levels(pd.to_datetime(df.index.levels[level], utc=True), level=level)
+    elif df.index.name == 'datetime' and df.index.dtype == object:
+        df = df.copy(deep=False)
+        df.index = pd.to_datetime(df.index, utc=True)
+    return df
+
+
+def _df_to_netcdf_bytes(df: pd.DataFrame) -> bytes:
+    # netcdf has no timezone aware type so datetimes are written as UTC
+    if isinstance(df.index, pd.DatetimeIndex) and df.index.tz is not None:
+        df = df.copy(deep=False)
+        df.index = df.index.tz_convert('UTC').tz_localize(None)
+    elif isinstance(df.index, pd.MultiIndex):
+        df = df.copy(deep=False)
+        for level, values in enumerate(df.index.levels):
+            if isinstance(values, pd.DatetimeIndex) and values.tz is not None:
+                df.index = df.index.set_levels(values.tz_convert('UTC').tz_localize(None), level=level)
+    dataset = xr.Dataset.from_dataframe(df)
+    dataset.attrs['units'] = 'cubic meters per second'
+
+    fd, path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        dataset.to_netcdf(path, engine='netcdf4')
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+@stage('serialize')
+def df_to_jsonify_response(df: pd.DataFrame, river_id: int | list):
+    if isinstance(df.index, pd.MultiIndex):
+        # multi river responses are one row per river per time step, with the river id as a column
+        df = df.reset_index(level='river_id')
+    # datetime indexes are written from their datetime64 values in the API's date format by the encoder
     json_template = new_json_template(river_id, start_date=df.index[0], end_date=df.index[-1])
-    json_template['datetime'] = df.index.tolist()
-    json_template.update(df.replace(np.nan, '').to_dict(orient='list'))
-    return jsonify(json_template)
+    json_template['datetime'] = df.index.values
+    for column in df.columns:
+        json_template[str(column)] = df[column].values
+    return dict_to_json_response(json_template)
+
+
+@stage('serialize')
+def dict_to_json_response(data: dict, status: int = 200) -> Response:
+    """
+    Serializes a dictionary to a json response. numpy arrays, pandas Series and Index values are written straight from
+    their arrays instead of being converted to lists of python objects first. NaN and infinite values become "" in arrays,
+    lists and scalar values alike.
+    """
+    return Response(_encode_json(data), status=status, mimetype='application/json')
+
+
+def _encode_json(value) -> bytes:
+    if isinstance(value, dict):
+        return b'{' + b','.join(orjson.dumps(str(k)) + b':' + _encode_json(v) for k, v in value.items()) + b'}'
+    if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+        return _encode_json_array(np.asarray(value))
+    if isinstance(value, (list, tuple)):
+        return b'[' + b','.join(_encode_json(v) for v in value) + b']'
+    if isinstance(value, (float, np.floating)) and not np.isfinite(value):
+        # orjson writes NaN and infinity as null, the API has always written them as ""
+        return b'""'
+    return orjson.dumps(value, default=_json_default, option=JSON_OPTIONS)
+
+
+def _encode_json_array(values: np.ndarray) -> bytes:
+    if values.dtype.kind == 'M' and np.isnat(values).any():
+        # orjson cannot write NaT, the formatted dates are NaN there and written as null
+        return orjson.dumps(pd.DatetimeIndex(values).strftime('%Y-%m-%dT%X+00:00').tolist(), option=JSON_OPTIONS)
+    if values.dtype.kind in 'fiubM':
+        text = orjson.dumps(np.ascontiguousarray(values), option=JSON_OPTIONS)
+        if values.dtype.kind == 'f' and not np.isfinite(values).all():
+            # orjson writes NaN and infinity as null, the API has always written them as ""
+            text = text.replace(b'null', b'""')
+        return text
+    return orjson.dumps(values.tolist(), default=_json_default, option=JSON_OPTIONS)
+
+
+def _json_default(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value) if np.isfinite(value) else ''
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return value.strftime('%Y-%m-%dT%X+00:00')
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
 
 
 def new_json_template(river_id, start_date, end_date):
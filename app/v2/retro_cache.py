@@ -0,0 +1,104 @@
+import os
+import pickle
+
+import geoglows
+import pandas as pd
+
+from .constants import RETRO_CACHE_DIR, RETRO_CACHE_MAX_BYTES, RETRO_SOURCE_DIR, RETRO_VERSION
+from .disk_cache import DiskLRUCache
+from .metrics import stage
+
+__all__ = [
+    'get_retrospective',
+    'get_bias_corrected_retrospective',
+    'retrospective_version',
+]
+
+# the geoglows.data function that fetches each retrospective product from the object store
+RETRO_PRODUCTS = {
+    'retro_hourly': lambda river_id: geoglows.data.retro_hourly(river_id, skip_log=True),
+    'retro_daily': lambda river_id: geoglows.data.retro_daily(river_id, skip_log=True),
+    'retro_monthly': lambda river_id: geoglows.data.retro_monthly(river_id, skip_log=True),
+    'retro_yearly': lambda river_id: geoglows.data.retro_yearly(river_id, skip_log=True),
+    'return_periods': lambda river_id: geoglows.data.return_periods(river_id, skip_log=True),
+}
+
+# products computed from other cached products rather than fetched
+DERIVED_PRODUCTS = {
+    'retro_daily_bias_corrected': lambda river_id: _bias_correct_retro_daily(river_id),
+    'retro_annual_max_bias_corrected': lambda river_id: _annual_max_bias_corrected(river_id),
+}
+
+# trim the cache on every 20th write per worker so a miss does not also walk the cache directory. the entries are larger
+# than the responses so the cache is checked more often than the response cache and overshoots it by less
+_cache = DiskLRUCache(RETRO_CACHE_DIR, RETRO_CACHE_MAX_BYTES, evict_every=20, name='retrospective')
+
+
+@stage('select')
+def get_retrospective(product: str, river_id: int) -> pd.DataFrame:
+    """
+    Returns a retrospective product for a river from the on disk cache shared by every worker on the node, fetching and
+    caching it on a miss. The least recently read files are deleted when the cache grows past RETRO_CACHE_MAX_BYTES.
+
+    Set RETRO_SOURCE_DIR to read from pickled dataframes at <RETRO_SOURCE_DIR>/<product>/<river_id>.pickle instead of
+    the object store, e.g. for local development and benchmarks.
+    """
+    if product not in RETRO_PRODUCTS and product not in DERIVED_PRODUCTS:
+        raise ValueError(f'Unknown retrospective product {product}. Choose from {list(RETRO_PRODUCTS)}')
+
+    key = os.path.join(retrospective_version(), product, f'{int(river_id)}.pickle')
+    data = _cache.read(key)
+    if data is not None:
+        return pickle.loads(data)
+
+    df = _fetch(product, river_id)
+    _cache.write(key, pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+    return df
+
+
+def get_bias_corrected_retrospective(river_id: int) -> pd.DataFrame:
+    """
+    Returns the bias corrected retrospective daily flows for a river with the uncorrected flows in a
+    "<river_id>_original" column. The correction runs once per river per retrospective version and is cached with the
+    other retrospective products so every bias corrected product resamples or aggregates the same result.
+    """
+    return get_retrospective('retro_daily_bias_corrected', river_id)
+
+
+def retrospective_version() -> str:
+    """
+    The version of the retrospective data that cache entries and validators are keyed by. This is RETRO_VERSION for the
+    object store, which must change with every data release. For a RETRO_SOURCE_DIR the latest mtime of the directory
+    and its product directories is added so replacing the local data invalidates the cached copies.
+    """
+    if not RETRO_SOURCE_DIR:
+        return RETRO_VERSION
+    mtimes = [os.stat(RETRO_SOURCE_DIR).st_mtime]
+    with os.scandir(RETRO_SOURCE_DIR) as entries:
+        mtimes += [entry.stat().st_mtime for entry in entries if entry.is_dir()]
+    return f'{RETRO_VERSION}-{int(max(mtimes))}'
+
+
+def _bias_correct_retro_daily(river_id: int) -> pd.DataFrame:
+    sim_data = get_retrospective('retro_daily', river_id)
+    with stage('bias'):
+        df = geoglows.bias.sfdc_bias_correction(sim_data, river_id)
+    df[f"{river_id}_original"] = sim_data[river_id]
+    return df
+
+
+def _annual_max_bias_corrected(river_id: int) -> pd.DataFrame:
+    # grouping by the integer year avoids formatting every timestamp of the daily record as a string
+    df = get_bias_corrected_retrospective(river_id)
+    return df.groupby(df.index.year).max()
+
+
+def _fetch(product: str, river_id: int) -> pd.DataFrame:
+    if product in DERIVED_PRODUCTS:
+        return DERIVED_PRODUCTS[product](river_id)
+    if RETRO_SOURCE_DIR:
+        source_file = os.path.join(RETRO_SOURCE_DIR, product, f'{int(river_id)}.pickle')
+        if not os.path.exists(source_file):
+            raise ValueError(f'Retrospective data not found for river_id {river_id}')
+        return pd.read_pickle(source_file)
+    return RETRO_PRODUCTS[product](river_id)
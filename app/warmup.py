@@ -0,0 +1,75 @@
+"""
+Warms up the app in the uwsgi master process before it forks the workers so every worker, including the ones respawned
+after --max-requests or --max-worker-lifetime, starts with the heavy modules imported and the indexes built.
+"""
+import importlib
+import os
+import time
+
+__all__ = ['warm_up', 'WARMUP_TIMINGS']
+
+HEAVY_MODULES = (
+    'numpy', 'pandas', 'xarray', 'dask', 'zarr', 'netCDF4', 'pyarrow', 'scipy.spatial', 'boto3', 'shapely',
+    'hydrostats', 'geoglows',
+)
+WARMUP_PRODUCTS = os.getenv(
+    'WARMUP_PRODUCTS',
+    'dates,forecast,forecaststats,forecastensemble,forecastrecords,getriverid',
+)
+# never requested in the master, even if listed in WARMUP_PRODUCTS: hydroviewer starts a thread pool the forked workers
+# do not inherit, and the retrospective products fetch from the object store when the app starts
+SKIPPED_PRODUCTS = frozenset({
+    'hydroviewer', 'returnperiods', 'retrospectivehourly', 'retrospectivedaily', 'retrospectivemonthly',
+    'dailyaverages', 'monthlyaverages', 'annualaverages',
+})
+
+# seconds spent on each warm up step, reported when the app starts
+WARMUP_TIMINGS = {}
+
+
+def warm_up(app) -> dict:
+    """
+    Imports heavy modules, loads the forecast catalog and metadata indexes, and requests each product in WARMUP_PRODUCTS
+    that is not in SKIPPED_PRODUCTS once for a river from the metadata table. Failures are reported and skipped so the
+    app still starts without data.
+    """
+    start = time.perf_counter()
+    for module in HEAVY_MODULES:
+        _timed(f'import {module}', importlib.import_module, module)
+
+    from v1.model_utilities import region_boundaries_index
+    from v2.data import find_available_dates, open_forecast_dataset, load_vpu_index, load_river_location_index
+    _timed('forecast catalog', find_available_dates)
+    _timed('latest forecast dataset', open_forecast_dataset, 'latest')
+    vpu_index = _timed('v2 river id index', load_vpu_index)
+    _timed('v2 river location index', load_river_location_index)
+    _timed('v1 region boundaries index', region_boundaries_index)
+
+    river_id = os.getenv('WARMUP_RIVER_ID')
+    if river_id is None and vpu_index is not None and vpu_index[0].size:
+        river_id = int(vpu_index[0][0])
+    client = app.test_client()
+    for product in [p.strip() for p in WARMUP_PRODUCTS.split(',') if p.strip()]:
+        if product in SKIPPED_PRODUCTS:
+            print(f'Warm up skips {product}, it cannot be requested before the workers are forked')
+            continue
+        path = f'/api/v2/{product}/' if product in ('dates', 'getriverid') else f'/api/v2/{product}/{river_id}'
+        query = {'source': 'warmup', 'format': 'json', 'lat': 0, 'lon': 0}
+        response = _timed(f'request {product}', client.get, path, query_string=query)
+        if response is not None and response.status_code != 200:
+            print(f'Warm up request for {product} returned {response.status_code}')
+
+    WARMUP_TIMINGS['total'] = time.perf_counter() - start
+    for step, seconds in WARMUP_TIMINGS.items():
+        print(f'Warm up {step}: {seconds:.3f}s')
+    return WARMUP_TIMINGS
+
+
+def _timed(step: str, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        print(f'Warm up {step} failed: {e}')
+    finally:
+        WARMUP_TIMINGS[step] = time.perf_counter() - start
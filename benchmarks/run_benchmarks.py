@@ -0,0 +1,345 @@
+"""
+Benchmarks every v2 and v1 product through the Flask test client against synthetic data built by synthetic_data.py.
+geoglows.data and geoglows.bias are replaced by readers of the local retrospective fixtures and CloudWatch logging by a
+client that discards the events, so nothing leaves the machine.
+
+Each case (product, format and options) runs in a process forked from one that imported the app, like a uwsgi worker
+forked from the master, and reports the latency of its first request, the p50/p95/p99 latency and throughput of the
+requests after it, and the peak RSS of the process.
+
+    python benchmarks/run_benchmarks.py                                   # every case at the default scale
+    python benchmarks/run_benchmarks.py --rivers 20000 --iterations 100   # a larger forecast, more requests per case
+    python benchmarks/run_benchmarks.py --products forecast,hydroviewer --formats json
+    python benchmarks/run_benchmarks.py --metadata-arrays --precompute-stats --warm-up --output results.json
+    python benchmarks/run_benchmarks.py --rechunk --products forecastensemble   # compare to a run without --rechunk
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from synthetic_data import REPO_DIR, build_fixtures, fixture_environment
+
+V2_FORMATS = ('csv', 'json', 'parquet', 'arrow', 'netcdf')
+V1_FORMATS = ('csv', 'json')
+V2_RIVER_PRODUCTS = (
+    'forecast', 'forecaststats', 'forecastensemble', 'forecastrecords',
+    'retrospectivehourly', 'retrospectivedaily', 'retrospectivemonthly',
+    'dailyaverages', 'monthlyaverages', 'annualaverages', 'returnperiods',
+)
+V1_REACH_PRODUCTS = (
+    'ForecastStats', 'ForecastEnsembles', 'ForecastRecords',
+    'HistoricSimulation', 'ReturnPeriods', 'DailyAverages', 'MonthlyAverages',
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'geoglows-benchmark'),
+                        help='where the synthetic data and caches are written')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the synthetic data even if it exists')
+    parser.add_argument('--rivers', type=int, default=2_000, help='v2 rivers in the synthetic forecasts')
+    parser.add_argument('--vpus', type=int, default=4, help='VPUs the v2 rivers are divided between')
+    parser.add_argument('--dates', type=int, default=2, help='daily v2 forecasts ending today')
+    parser.add_argument('--rivid-chunk', type=int, default=1_000, help='rivers per chunk of the forecast zarrs')
+    parser.add_argument('--sample-rivers', type=int, default=10, help='rivers the requests cycle through')
+    parser.add_argument('--retro-years', type=int, default=20, help='years of retrospective data per river')
+    parser.add_argument('--v1-rivers', type=int, default=500, help='reaches per v1 region')
+    parser.add_argument('--iterations', type=int, default=20, help='requests per case after the first')
+    parser.add_argument('--threads', type=int, default=1, help='threads making the requests of a case at once')
+    parser.add_argument('--versions', default='v2,v1', help='comma separated api versions to benchmark')
+    parser.add_argument('--products', default=None, help='comma separated products to benchmark, default all')
+    parser.add_argument('--formats', default=None, help='comma separated formats to benchmark, default all')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='keep the shared response cache enabled so repeated requests are served from it')
+    parser.add_argument('--metadata-arrays', action='store_true', help='build the memory mapped metadata arrays')
+    parser.add_argument('--precompute-stats', action='store_true', help='write the forecast statistics stores')
+    parser.add_argument('--rechunk', action='store_true', help='write the river-major copies of the forecasts')
+    parser.add_argument('--warm-up', action='store_true', help='warm up the app before forking each case')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    args = parser.parse_args()
+
+    fixtures_dir = os.path.join(args.data_dir, 'fixtures')
+    start = time.perf_counter()
+    manifest = build_fixtures(
+        fixtures_dir, rivers=args.rivers, vpus=args.vpus, dates=args.dates, sample_rivers=args.sample_rivers,
+        rivid_chunk=args.rivid_chunk, retro_years=args.retro_years, v1_rivers=args.v1_rivers, rebuild=args.rebuild,
+    )
+    print(f'Synthetic data ready in {time.perf_counter() - start:.1f}s at {fixtures_dir}')
+
+    app = load_app(args, fixtures_dir)
+    cases = select_cases(build_cases(manifest), args)
+    results = []
+    for case in cases:
+        result = run_case_in_child(app, case, args.iterations, args.threads)
+        results.append(result)
+        print(format_row(result), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'params': manifest['params'], 'args': vars(args), 'results': results}, f, indent=2)
+
+
+def load_app(args, fixtures_dir: str):
+    """
+    Points the app at the fixtures, replaces the services it would call over the network and imports it
+    """
+    caches_dir = os.path.join(args.data_dir, 'caches')
+    shutil.rmtree(caches_dir, ignore_errors=True)
+    os.environ.update(fixture_environment(fixtures_dir))
+    os.environ.update({
+        'APP_WARMUP': 'false',
+        'RETRO_CACHE_DIR': os.path.join(caches_dir, 'retrospective'),
+        'RESPONSE_CACHE_DIR': os.path.join(caches_dir, 'responses'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(caches_dir, 'metrics'),
+    })
+    if not args.response_cache:
+        os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    # the derived stores are only read when they exist, remove the ones written by earlier runs unless asked for
+    if not args.metadata_arrays:
+        shutil.rmtree(os.environ['METADATA_ARRAYS_DIR'], ignore_errors=True)
+    for enabled, pattern in ((args.precompute_stats, 'forecaststats_*.zarr'), (args.rechunk, 'forecastrivers_*.zarr')):
+        if not enabled:
+            for path in glob.glob(os.path.join(os.environ['V2_PATH_TO_FORECASTS'], pattern)):
+                shutil.rmtree(path)
+    sys.path.insert(0, os.path.join(REPO_DIR, 'app'))
+
+    stub_geoglows(os.path.join(fixtures_dir, 'retrospective'))
+
+    import app as api
+    import analytics_queue
+
+    analytics_queue.log_queue.client_factory = DiscardingLogsClient
+    if args.metadata_arrays:
+        from v2.build_metadata_arrays import build_metadata_arrays
+        build_metadata_arrays(os.environ['METADATA_ARRAYS_DIR'])
+    if args.precompute_stats:
+        from v2.data import find_available_dates
+        from v2.precompute_forecast_stats import write_forecast_stats_store
+        for date in find_available_dates():
+            write_forecast_stats_store(date, overwrite=True)
+    if args.rechunk:
+        from v2.data import find_available_dates
+        from v2.rechunk_forecast import write_river_major_store
+        for date in find_available_dates():
+            write_river_major_store(date, overwrite=True)
+    if args.warm_up:
+        from warmup import warm_up
+        warm_up(api.app)
+    return api.app
+
+
+def stub_geoglows(retrospective_dir: str) -> None:
+    """
+    Replaces the geoglows functions that read from the object store with readers of the local retrospective pickles
+    """
+    import geoglows
+
+    def reader(product):
+        def read(river_id, **kwargs):
+            path = os.path.join(retrospective_dir, product, f'{int(river_id)}.pickle')
+            if not os.path.exists(path):
+                raise ValueError(f'No synthetic {product} data for river_id {river_id}')
+            return pd.read_pickle(path)
+        return read
+
+    for product in ('retro_hourly', 'retro_daily', 'retro_monthly', 'retro_yearly', 'return_periods'):
+        setattr(geoglows.data, product, reader(product))
+
+    # the saturated flow duration curve correction needs the gauge data, scale the flows by a constant instead
+    def sfdc_bias_correction(df, river_id, **kwargs):
+        return (df.astype(np.float64) * 0.9).rename(columns=str)
+
+    geoglows.bias.sfdc_bias_correction = sfdc_bias_correction
+
+
+class DiscardingLogsClient:
+    def put_log_events(self, **kwargs):
+        return {}
+
+
+def build_cases(manifest: dict) -> list:
+    """
+    Every product and format of both api versions as dicts of the name, path and query string of the requests. Each
+    request uses the next river or location in the manifest so a case does not read one river over and over.
+    """
+    river_ids = manifest['river_ids']
+    locations = manifest['locations']
+    cases = []
+
+    def v2_case(product, return_format, variant='', paths=None, params=None):
+        cases.append({
+            'version': 'v2', 'product': product, 'format': return_format, 'variant': variant,
+            'paths': paths or [f'/api/v2/{product}/{river_id}' for river_id in river_ids],
+            'params': [{'format': return_format, **(p or {})} for p in (params or [{}])],
+        })
+
+    for product in V2_RIVER_PRODUCTS:
+        for return_format in V2_FORMATS:
+            v2_case(product, return_format)
+    for product in ('forecast', 'retrospectivedaily', 'returnperiods'):
+        v2_case(product, 'json', 'bias_corrected', params=[{'bias_corrected': 'true'}])
+    # date ranges filter the utc indexed retrospective data and read the forecast records from two yearly files
+    last_retro_year = int(manifest['params']['built'][:4]) - 1
+    retro_range = {'start_date': f'{last_retro_year - 4}0101', 'end_date': f'{last_retro_year - 1}1231'}
+    for product in ('retrospectivehourly', 'retrospectivedaily', 'retrospectivemonthly'):
+        v2_case(product, 'json', 'date_range', params=[retro_range])
+    v2_case('forecastrecords', 'json', 'two_years', params=[{'start_date': manifest['records_start']}])
+    multi_river = ','.join(str(r) for r in river_ids)
+    for return_format in ('csv', 'json', 'parquet'):
+        v2_case('forecast', return_format, f'{len(river_ids)}_rivers', paths=[f'/api/v2/forecast/{multi_river}'])
+    v2_case('hydroviewer', 'json')
+    records_start = (datetime.utcnow() - timedelta(days=30)).strftime('%Y%m%d')
+    v2_case('hydroviewer', 'json', 'records', params=[{'start_date': records_start}])
+    v2_case('hydroviewer', 'json', 'bias_corrected', params=[{'bias_corrected': 'true'}])
+    for return_format in ('csv', 'json'):
+        v2_case('dates', return_format, paths=['/api/v2/dates/'])
+    v2_case('getriverid', 'json', paths=['/api/v2/getriverid/'],
+            params=[{'lat': lat, 'lon': lon} for lat, lon in locations])
+
+    reach_ids = [r for region_reaches in manifest['v1_reach_ids'].values() for r in region_reaches]
+    regions = list(manifest['v1_reach_ids'])
+
+    def v1_case(product, return_format, params):
+        cases.append({
+            'version': 'v1', 'product': product, 'format': return_format, 'variant': '',
+            'paths': [f'/api/v1/{product}'],
+            'params': [{'return_format': return_format, **p} for p in params],
+        })
+
+    for product in V1_REACH_PRODUCTS:
+        for return_format in V1_FORMATS:
+            v1_case(product, return_format, [{'reach_id': r} for r in reach_ids])
+    for return_format in V1_FORMATS:
+        v1_case('ForecastWarnings', return_format, [{'region': r} for r in regions])
+    v1_case('AvailableDates', 'json', [{'region': r} for r in regions])
+    v1_case('AvailableRegions', 'json', [{}])
+    v1_case('AvailableData', 'json', [{}])
+    v1_case('GetReachID', 'json', [{'lat': lat, 'lon': lon} for lat, lon in manifest['v1_locations']])
+    return cases
+
+
+def select_cases(cases: list, args) -> list:
+    versions = set(args.versions.split(','))
+    products = {p.lower() for p in args.products.split(',')} if args.products else None
+    formats = set(args.formats.split(',')) if args.formats else None
+    return [
+        case for case in cases
+        if case['version'] in versions
+        and (products is None or case['product'].lower() in products)
+        and (formats is None or case['format'] in formats)
+    ]
+
+
+def run_case_in_child(app, case: dict, iterations: int, threads: int) -> dict:
+    """
+    Runs a case in a forked process so its memory use is measured on its own and it starts as cold as a new worker
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case, args=(app, case, iterations, threads, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': f'benchmark process exited with code {process.exitcode}'}
+    process.join()
+    return {key: case[key] for key in ('version', 'product', 'format', 'variant')} | result
+
+
+def _run_case(app, case: dict, iterations: int, threads: int, sender) -> None:
+    try:
+        sender.send(measure_case(app, case, iterations, threads))
+    except Exception:
+        sender.send({'error': traceback.format_exc(limit=3)})
+    finally:
+        sender.close()
+
+
+def measure_case(app, case: dict, iterations: int, threads: int) -> dict:
+    start_rss = _current_rss_mb()
+    requests = [
+        (case['paths'][i % len(case['paths'])], case['params'][i % len(case['params'])])
+        for i in range(iterations + 1)
+    ]
+    errors = []
+
+    def timed_request(request):
+        path, params = request
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.get(path, query_string=params)
+        body = response.get_data()  # consumes streamed responses
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            errors.append(f'{response.status_code} {path} {body[:200]!r}')
+        return elapsed, len(body)
+
+    cold, _ = timed_request(requests[0])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        measurements = list(executor.map(timed_request, requests[1:]))
+    wall = time.perf_counter() - start
+
+    latencies = np.array([m[0] for m in measurements]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies.size else (np.nan,) * 3
+    peak_rss = _peak_rss_mb()
+    return {
+        'requests': len(requests),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'cold_ms': cold * 1000,
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'throughput_rps': len(measurements) / wall if wall else np.nan,
+        'mean_bytes': float(np.mean([m[1] for m in measurements])) if measurements else 0,
+        'peak_rss_mb': peak_rss,
+        'rss_growth_mb': peak_rss - start_rss,
+    }
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except OSError:
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def format_row(result: dict) -> str:
+    name = f"{result['version']} {result['product']} {result['format']} {result['variant']}".strip()
+    if 'p50_ms' not in result:
+        return f'{name:<48} ERROR {result["error"]}'
+    row = (
+        f"{name:<48} cold {result['cold_ms']:9.1f}ms  p50 {result['p50_ms']:8.1f}ms  p95 {result['p95_ms']:8.1f}ms  "
+        f"p99 {result['p99_ms']:8.1f}ms  {result['throughput_rps']:8.1f} req/s  "
+        f"peak rss {result['peak_rss_mb']:7.0f}MB (+{result['rss_growth_mb']:.0f}MB)"
+    )
+    if result['errors']:
+        row += f"  {result['errors']} errors, first: {result['first_error']}"
+    return row
+
+
+if __name__ == '__main__':
+    main()
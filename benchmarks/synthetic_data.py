@@ -0,0 +1,307 @@
+"""
+Builds synthetic GEOGLOWS data in the directory layout the API reads in production so every product can be benchmarked
+without the model output volume or the object store:
+
+    <root>/v2/forecasts/Qout_<YYYYMMDDHH>.zarr                       (ensemble, time, rivid)
+    <root>/v2/forecast-records/forecastrecord_<vpu>_<year>.nc         (time, rivid)
+    <root>/package-metadata-table.parquet and extra-metadata-table.parquet
+    <root>/retrospective/<product>/<river_id>.pickle                  what geoglows.data returns for each river
+    <root>/v1/forecasts/<region>/<YYYYMMDD>.00/Qout_<region>_<ensemble>.nc and forecasted_return_periods_summary.csv
+    <root>/v1/forecast-records/<region>/forecast_record-<year>-<region>.nc
+    <root>/v1/era-5/<region>/Qout_era5_*.nc, return_periods_era5_*.nc and era5_pandas_dataframe_template.pickle
+
+The v1 reach ids and locations are sampled from the region pickles in app/geometry, and the locations are the reaches
+that the region boundaries in app/geometry/boundaries.pickle put in their own region so GetReachID finds them.
+"""
+import json
+import os
+import pickle
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import shapely
+import xarray as xr
+from shapely.geometry import shape
+
+__all__ = [
+    'build_fixtures',
+    'fixture_environment',
+]
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GEOMETRY_DIR = os.path.join(REPO_DIR, 'app', 'geometry')
+
+FIRST_LINKNO = 110_000_000
+FORECAST_STEPS = 121  # 15 days at 3 hours
+HIGH_RES_STEPS = 81  # the high resolution member stops after 10 days
+ENSEMBLES = np.arange(1, 53)
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+V1_REGIONS = ('south_america-geoglows', 'north_america-geoglows')
+V1_ERA5_START = '1979-01-01'
+V1_ERA5_END = '2018-12-31'
+# part of the build parameters so fixtures written by an older version of this module are rebuilt
+FIXTURES_VERSION = 2
+
+
+def fixture_environment(root: str) -> dict:
+    """
+    The environment variables that point the API at the fixtures under root
+    """
+    return {
+        'V2_PATH_TO_FORECASTS': os.path.join(root, 'v2', 'forecasts'),
+        'V2_PATH_TO_FORECAST_RECORDS': os.path.join(root, 'v2', 'forecast-records'),
+        'PYGEOGLOWS_METADATA_TABLE_PATH': os.path.join(root, 'package-metadata-table.parquet'),
+        'PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH': os.path.join(root, 'extra-metadata-table.parquet'),
+        'METADATA_ARRAYS_DIR': os.path.join(root, 'metadata-arrays'),
+        'V1_PATH_TO_FORECASTS': os.path.join(root, 'v1', 'forecasts'),
+        'V1_PATH_TO_FORECAST_RECORDS': os.path.join(root, 'v1', 'forecast-records'),
+        'V1_PATH_TO_ERA_5': os.path.join(root, 'v1', 'era-5'),
+        'V1_PATH_TO_ERA_INTERIM': os.path.join(root, 'v1', 'era-interim'),
+        'V1_PATH_TO_GEOMETRY': GEOMETRY_DIR,
+    }
+
+
+def build_fixtures(root: str, rivers: int = 2_000, vpus: int = 4, dates: int = 2, sample_rivers: int = 10,
+                   rivid_chunk: int = 1_000, retro_years: int = 20, v1_rivers: int = 500, v1_dates: int = 1,
+                   seed: int = 0, rebuild: bool = False) -> dict:
+    """
+    Writes the fixtures under root, or reuses them if they were already built with the same arguments. A previous build
+    under root is deleted first, including the derived stores and metadata arrays written from it.
+
+    Args:
+        root: directory the fixtures are written to
+        rivers: number of v2 rivers in the metadata tables, forecasts and forecast records
+        vpus: number of VPUs the v2 rivers are divided between, one forecast record file per VPU and year
+        dates: number of daily v2 forecasts ending today. The forecast records start at least 60 days before today and
+            always include December of last year so reading them crosses a year boundary
+        sample_rivers: number of v2 rivers requested by the benchmark, the only rivers with retrospective data
+        rivid_chunk: rivers per chunk of the forecast zarrs
+        retro_years: years of retrospective data ending last year
+        v1_rivers: number of reaches per v1 region
+        v1_dates: number of daily v1 forecasts ending today
+        seed: seed for the random flows
+        rebuild: write the fixtures even if a matching build exists
+
+    Returns:
+        dict: the manifest of the build, including the dates and the river ids and locations to request
+    """
+    params = {
+        'rivers': rivers, 'vpus': vpus, 'dates': dates, 'sample_rivers': sample_rivers, 'rivid_chunk': rivid_chunk,
+        'retro_years': retro_years, 'v1_rivers': v1_rivers, 'v1_dates': v1_dates, 'seed': seed,
+        'built': datetime.utcnow().strftime('%Y%m%d'), 'version': FIXTURES_VERSION,
+    }
+    manifest_path = os.path.join(root, 'manifest.json')
+    if not rebuild and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['params'] == params:
+            return manifest
+
+    # remove the previous build, with the stores derived from its forecasts, so nothing from it is read with the new one
+    env = fixture_environment(root)
+    for path in (os.path.join(root, 'v2'), os.path.join(root, 'v1'), os.path.join(root, 'retrospective'),
+                 env['METADATA_ARRAYS_DIR']):
+        shutil.rmtree(path, ignore_errors=True)
+    for path in (manifest_path, env['PYGEOGLOWS_METADATA_TABLE_PATH'], env['PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH']):
+        if os.path.exists(path):
+            os.remove(path)
+
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp(datetime.utcnow().date())
+    manifest = {'params': params}
+
+    # v2 metadata tables. LINKNOs are written out of order like the published tables
+    linknos = FIRST_LINKNO + np.arange(rivers, dtype=np.int64) * 3
+    vpu_codes = 101 + np.arange(rivers) * vpus // rivers
+    lat = rng.uniform(-55, 70, rivers)
+    lon = rng.uniform(-180, 180, rivers)
+    base_flows = rng.lognormal(3, 1.5, rivers)
+    order = rng.permutation(rivers)
+    pd.DataFrame({
+        'LINKNO': linknos[order],
+        'DSLINKNO': np.roll(linknos, -1)[order],
+        'strmOrder': rng.integers(1, 10, rivers)[order],
+        'VPUCode': vpu_codes[order],
+    }).to_parquet(env['PYGEOGLOWS_METADATA_TABLE_PATH'])
+    pd.DataFrame({
+        'LINKNO': linknos[order],
+        'VPUCode': vpu_codes[order],
+        'lat': lat[order],
+        'lon': lon[order],
+    }).to_parquet(env['PYGEOGLOWS_EXTRA_METADATA_TABLE_PATH'])
+
+    sample = np.linspace(0, rivers - 1, min(sample_rivers, rivers)).astype(int)
+    manifest['river_ids'] = [int(r) for r in linknos[sample]]
+    manifest['locations'] = [[float(lat[i]), float(lon[i])] for i in sample]
+
+    # v2 forecasts and forecast records
+    os.makedirs(env['V2_PATH_TO_FORECASTS'], exist_ok=True)
+    forecast_dates = [today - timedelta(days=i) for i in range(dates)]
+    manifest['dates'] = [d.strftime('%Y%m%d00') for d in forecast_dates]
+    for date in forecast_dates:
+        path = os.path.join(env['V2_PATH_TO_FORECASTS'], f'Qout_{date:%Y%m%d}00.zarr')
+        _write_forecast_zarr(path, date, linknos, base_flows, rng, rivid_chunk)
+
+    os.makedirs(env['V2_PATH_TO_FORECAST_RECORDS'], exist_ok=True)
+    # at least two yearly files per vpu so the records are read across a year boundary
+    records_start = min(today - timedelta(days=60), pd.Timestamp(f'{today.year - 1}-12-01'))
+    manifest['records_start'] = records_start.strftime('%Y%m%d')
+    for vpu in np.unique(vpu_codes):
+        rivers_in_vpu = vpu_codes == vpu
+        for year in range(records_start.year, today.year + 1):
+            times = pd.date_range(max(pd.Timestamp(f'{year}-01-01'), records_start),
+                                  min(pd.Timestamp(f'{year}-12-31 21:00'), today), freq='3h')
+            path = os.path.join(env['V2_PATH_TO_FORECAST_RECORDS'], f'forecastrecord_{vpu}_{year}.nc')
+            xr.Dataset(
+                {'Qout': (('time', 'rivid'), _seasonal_flows(rng, times, base_flows[rivers_in_vpu]))},
+                coords={'time': times, 'rivid': linknos[rivers_in_vpu]},
+            ).to_netcdf(path)
+
+    # retrospective data for the sampled rivers, in the shapes geoglows.data returns, with a UTC index like geoglows
+    retro_times = pd.date_range(f'{today.year - retro_years}-01-01', f'{today.year - 1}-12-31', freq='D', tz='UTC')
+    for i in sample:
+        _write_retrospective(os.path.join(root, 'retrospective'), int(linknos[i]), retro_times,
+                             _seasonal_flows(rng, retro_times, base_flows[i:i + 1])[:, 0])
+
+    manifest['v1_reach_ids'] = {}
+    manifest['v1_locations'] = []
+    for region in V1_REGIONS:
+        reaches = pd.read_pickle(os.path.join(GEOMETRY_DIR, f'{region}-comid_lat_lon_z.pickle'))
+        reaches = reaches.iloc[np.linspace(0, len(reaches) - 1, min(v1_rivers, len(reaches))).astype(int)]
+        _write_v1_region(env, region, reaches, rng, today, v1_dates)
+        region_sample = np.linspace(0, len(reaches) - 1, min(sample_rivers, len(reaches))).astype(int)
+        manifest['v1_reach_ids'][region] = [int(r) for r in reaches.index[region_sample]]
+        located = reaches[_in_region_boundary(region, reaches)]
+        location_sample = np.linspace(0, len(located) - 1, min(sample_rivers, len(located))).astype(int)
+        manifest['v1_locations'] += [[float(row.Lat), float(row.Lon)] for row in located.iloc[location_sample].itertuples()]
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _in_region_boundary(region: str, reaches: pd.DataFrame) -> np.ndarray:
+    # the api puts a point in the first region boundary that contains it, some reaches fall in another region's boundary
+    # or outside every boundary
+    with open(os.path.join(GEOMETRY_DIR, 'boundaries.pickle'), 'rb') as f:
+        boundaries = json.loads(pickle.load(f))
+    lon, lat = reaches['Lon'].values, reaches['Lat'].values
+    unmatched = np.ones(len(reaches), dtype=bool)
+    matched = np.zeros(len(reaches), dtype=bool)
+    for name, collection in boundaries.items():
+        for feature in collection['features']:
+            inside = unmatched & shapely.contains_xy(shape(feature['geometry']), lon, lat)
+            if f'{name}-geoglows' == region:
+                matched |= inside
+            unmatched &= ~inside
+    return matched
+
+
+def _seasonal_flows(rng, times: pd.DatetimeIndex, base_flows: np.ndarray) -> np.ndarray:
+    # a yearly cycle with a different phase for each river and day to day noise around the river's mean flow
+    phase = rng.uniform(0, 1, base_flows.size)
+    season = 1 + 0.6 * np.sin(2 * np.pi * (times.dayofyear.values[:, np.newaxis] / 365.25 + phase[np.newaxis, :]))
+    noise = rng.lognormal(0, 0.25, (times.size, base_flows.size))
+    return (base_flows[np.newaxis, :] * season * noise).astype(np.float32)
+
+
+def _write_forecast_zarr(path: str, date: pd.Timestamp, linknos: np.ndarray, base_flows: np.ndarray, rng,
+                         rivid_chunk: int) -> None:
+    times = pd.date_range(date, periods=FORECAST_STEPS, freq='3h')
+    # written a chunk of rivers at a time so the memory needed does not grow with the number of rivers
+    for start in range(0, linknos.size, rivid_chunk):
+        rivers = slice(start, start + rivid_chunk)
+        walk = np.cumsum(rng.normal(0, 0.04, (ENSEMBLES.size, times.size, linknos[rivers].size)), axis=1)
+        qout = (base_flows[rivers] * np.exp(walk)).astype(np.float32)
+        qout[-1, HIGH_RES_STEPS:, :] = np.nan
+        ds = xr.Dataset(
+            {'Qout': (('ensemble', 'time', 'rivid'), qout)},
+            coords={'ensemble': ENSEMBLES, 'time': times, 'rivid': linknos[rivers]},
+        )
+        if start == 0:
+            ds.to_zarr(path, mode='w', encoding={'Qout': {'chunks': (ENSEMBLES.size, times.size, rivid_chunk)}})
+        else:
+            ds.to_zarr(path, append_dim='rivid')
+
+
+def _write_retrospective(directory: str, river_id: int, times: pd.DatetimeIndex, daily: np.ndarray) -> None:
+    daily = pd.DataFrame({river_id: daily.astype(np.float64)}, index=pd.DatetimeIndex(times, name='time'))
+    hourly = daily.resample('h').interpolate()
+    annual_max = daily[river_id].groupby(daily.index.year).max()
+    return_periods = np.asarray(RETURN_PERIODS, dtype=np.float64)
+    products = {
+        'retro_hourly': hourly,
+        'retro_daily': daily,
+        'retro_monthly': daily.resample('MS').mean(),
+        'retro_yearly': daily.resample('YS').mean(),
+        'return_periods': pd.DataFrame(
+            {river_id: -np.log(-np.log(1 - 1 / return_periods)) * annual_max.std() * .7797
+                       + annual_max.mean() - .45 * annual_max.std()},
+            index=pd.Index(RETURN_PERIODS, name='return_period'),
+        ),
+    }
+    for product, df in products.items():
+        os.makedirs(os.path.join(directory, product), exist_ok=True)
+        df.to_pickle(os.path.join(directory, product, f'{river_id}.pickle'))
+
+
+def _write_v1_region(env: dict, region: str, reaches: pd.DataFrame, rng, today: pd.Timestamp, dates: int) -> None:
+    reach_ids = reaches.index.values.astype(np.int64)
+    base_flows = rng.lognormal(3, 1.5, reach_ids.size)
+
+    # one netcdf per ensemble member in a folder per forecast date, plus the warnings summary
+    for date in [today - timedelta(days=i) for i in range(dates)]:
+        folder = os.path.join(env['V1_PATH_TO_FORECASTS'], region, f'{date:%Y%m%d}.00')
+        os.makedirs(folder, exist_ok=True)
+        times = pd.date_range(date, periods=FORECAST_STEPS, freq='3h')
+        walk = np.cumsum(rng.normal(0, 0.04, (ENSEMBLES.size, reach_ids.size, times.size)), axis=2)
+        qout = (base_flows[:, np.newaxis] * np.exp(walk)).astype(np.float32)
+        for ensemble, member in zip(ENSEMBLES, qout):
+            xr.Dataset(
+                {'Qout': (('rivid', 'time'), member)},
+                coords={'rivid': reach_ids, 'time': times},
+            ).to_netcdf(os.path.join(folder, f'Qout_{region}_{ensemble}.nc'))
+        flagged = rng.choice(reach_ids.size, min(50, reach_ids.size), replace=False)
+        pd.DataFrame({
+            'comid': reach_ids[flagged],
+            'stream_order': rng.integers(1, 10, flagged.size),
+            'stream_lat': reaches['Lat'].values[flagged],
+            'stream_lon': reaches['Lon'].values[flagged],
+            'max_forecasted_flow': qout[:, flagged, :].max(axis=(0, 2)),
+            'return_period': rng.choice(RETURN_PERIODS, flagged.size),
+        }).to_csv(os.path.join(folder, 'forecasted_return_periods_summary.csv'), index=False)
+
+    # the forecast record of the current year with times as seconds since the epoch
+    records_dir = os.path.join(env['V1_PATH_TO_FORECAST_RECORDS'], region)
+    os.makedirs(records_dir, exist_ok=True)
+    times = pd.date_range(f'{today.year}-01-01', today, freq='3h')
+    xr.Dataset(
+        {'Qout': (('time', 'rivid'), _seasonal_flows(rng, times, base_flows))},
+        coords={'time': (times.astype(np.int64) // 10 ** 9).values, 'rivid': reach_ids},
+    ).to_netcdf(os.path.join(records_dir, f'forecast_record-{today.year}-{region}.nc'))
+
+    # the era 5 simulation, its return periods and the dataframe template the flows are copied into
+    era5_dir = os.path.join(env['V1_PATH_TO_ERA_5'], region)
+    os.makedirs(era5_dir, exist_ok=True)
+    times = pd.date_range(V1_ERA5_START, V1_ERA5_END, freq='D')
+    flows = _seasonal_flows(rng, times, base_flows)
+    xr.Dataset(
+        {'Qout': (('time', 'rivid'), flows)},
+        coords={'time': times, 'rivid': reach_ids},
+    ).to_netcdf(os.path.join(era5_dir, 'Qout_era5_t640_24hr_19790101to20181231.nc'))
+    annual_max = pd.DataFrame(flows, index=times).groupby(times.year).max()
+    xbar, std = annual_max.mean().values, annual_max.std().values
+    return_periods = {
+        f'return_period_{rp}': ('rivid', -np.log(-np.log(1 - 1 / rp)) * std * .7797 + xbar - .45 * std)
+        for rp in sorted(RETURN_PERIODS, reverse=True)
+    }
+    xr.Dataset(
+        {'max_flow': ('rivid', annual_max.max().values), **return_periods,
+         'lat': ('rivid', reaches['Lat'].values), 'lon': ('rivid', reaches['Lon'].values)},
+        coords={'rivid': reach_ids},
+    ).to_netcdf(os.path.join(era5_dir, 'return_periods_era5_t640_24hr_19790101to20181231.nc'))
+    template = pd.DataFrame(index=pd.DatetimeIndex(times, name='datetime'))
+    template.to_pickle(os.path.join(env['V1_PATH_TO_ERA_5'], 'era5_pandas_dataframe_template.pickle'))
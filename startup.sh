@@ -1,3 +1,6 @@
 #!/bin/bash
 
+# the workers add to the metric files in this directory, start counting from zero each time the service starts
+rm -rf "${PROMETHEUS_MULTIPROC_DIR:-/tmp/geoglows-metrics}"
+
 uwsgi --master --max-requests 1000 --max-worker-lifetime 1800 --worker-reload-mercy 30 --virtualenv="/opt/conda/envs/app-env" --http 0.0.0.0:80 -b 32768 --die-on-term --enable-threads --log-date="%Y-%m-%d %H:%M:%S" --logformat-strftime --processes=8 --wsgi-file="/app/app.py" --callable app 
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+# the app modules import each other from the app directory, as they do when uwsgi runs there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+FORECAST_DATE = '2025010100'
+FORECAST_RIVER_IDS = [110_000_000, 110_000_003, 110_000_006, 110_000_009, 110_000_012]
+
+
+@pytest.fixture
+def forecast_dir(tmp_path, monkeypatch):
+    """
+    A forecast directory with one small Qout_<date>.zarr, with NaN steps in the high resolution member like the
+    published forecasts, that the v2 data module reads from
+    """
+    from v2 import data
+
+    rng = np.random.default_rng(0)
+    times = pd.date_range(FORECAST_DATE[:8], periods=12, freq='3h')
+    qout = rng.lognormal(2, 1, (52, times.size, len(FORECAST_RIVER_IDS))).astype(np.float32)
+    qout[-1, 8:, :] = np.nan
+    xr.Dataset(
+        {'Qout': (('ensemble', 'time', 'rivid'), qout)},
+        coords={'ensemble': np.arange(1, 53), 'time': times, 'rivid': FORECAST_RIVER_IDS},
+    ).to_zarr(tmp_path / f'Qout_{FORECAST_DATE}.zarr', encoding={'Qout': {'chunks': (52, times.size, 2)}})
+
+    monkeypatch.setattr(data, 'PATH_TO_FORECASTS', str(tmp_path))
+    monkeypatch.setitem(data._forecast_catalog, 'mtime', None)
+    data._forecast_datasets.clear()
+    yield tmp_path
+    for dataset, _ in data._forecast_datasets.values():
+        dataset.close()
+    data._forecast_datasets.clear()
@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from analytics_queue import LogEventQueue
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+
+
+class StubLogsClient:
+    def __init__(self):
+        self.batches = []
+
+    def put_log_events(self, **kwargs):
+        self.batches.append(kwargs['logEvents'])
+        return {}
+
+
+class ManualLogEventQueue(LogEventQueue):
+    # no background thread so the tests decide when events are sent
+    def _ensure_worker(self):
+        pass
+
+
+def make_queue(**kwargs):
+    client = StubLogsClient()
+    return ManualLogEventQueue(lambda: client, 'group', 'stream', **kwargs), client
+
+
+def test_flush_sends_batches_of_batch_size():
+    log_queue, client = make_queue(batch_size=2)
+    for i in range(5):
+        assert log_queue.put({'reach_id': i})
+    log_queue.flush()
+
+    assert [len(batch) for batch in client.batches] == [2, 2, 1]
+    assert log_queue.counts == {'queued': 5, 'sent': 5, 'dropped': 0, 'failed': 0}
+
+
+def test_batches_are_sent_in_timestamp_order():
+    log_queue, client = make_queue()
+    for timestamp in (3, 1, 2):
+        log_queue.events.put_nowait({'timestamp': timestamp, 'message': str(timestamp)})
+    log_queue.flush()
+
+    assert [event['timestamp'] for event in client.batches[0]] == [1, 2, 3]
+
+
+def test_events_are_dropped_and_counted_when_the_queue_is_full():
+    counted = []
+    log_queue, client = make_queue(max_size=2, on_count=lambda event, n: counted.append((event, n)))
+    assert log_queue.put({'reach_id': 1})
+    assert log_queue.put({'reach_id': 2})
+    assert not log_queue.put({'reach_id': 3})
+
+    assert log_queue.counts['dropped'] == 1
+    assert ('dropped', 1) in counted
+    log_queue.flush()
+    assert sum(len(batch) for batch in client.batches) == 2
+
+
+def test_failed_batches_are_counted():
+    class FailingLogsClient:
+        def put_log_events(self, **kwargs):
+            raise RuntimeError('unavailable')
+
+    log_queue = ManualLogEventQueue(FailingLogsClient, 'group', 'stream')
+    log_queue.put({'reach_id': 1})
+    log_queue.flush()
+
+    assert log_queue.counts['failed'] == 1
+
+
+def test_close_sends_the_batch_held_by_the_background_thread():
+    client = StubLogsClient()
+    log_queue = LogEventQueue(lambda: client, 'group', 'stream', batch_size=100, flush_interval=60)
+    for i in range(3):
+        log_queue.put({'reach_id': i})
+    log_queue.close()
+
+    assert sum(len(batch) for batch in client.batches) == 3
+    assert not log_queue._thread.is_alive()
+
+
+def test_queued_events_are_sent_when_the_process_exits():
+    script = textwrap.dedent('''
+        import analytics_queue
+
+        class PrintingLogsClient:
+            def put_log_events(self, **kwargs):
+                print(len(kwargs['logEvents']), flush=True)
+
+        analytics_queue.log_queue.client_factory = PrintingLogsClient
+        analytics_queue.log_queue.flush_interval = 60
+        for i in range(4):
+            analytics_queue.log_queue.put({'reach_id': i})
+    ''')
+    result = subprocess.run([sys.executable, '-c', script], cwd=APP_DIR, capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert sum(int(line) for line in result.stdout.split()) == 4
@@ -0,0 +1,35 @@
+import os
+import stat
+
+from v2.disk_cache import DiskLRUCache
+
+
+def test_directory_is_created_private(tmp_path):
+    cache = DiskLRUCache(str(tmp_path / 'cache'), max_bytes=1024)
+    cache.write(os.path.join('ab', 'entry'), b'data')
+
+    assert cache.read(os.path.join('ab', 'entry')) == b'data'
+    assert stat.S_IMODE(os.stat(tmp_path / 'cache').st_mode) == 0o700
+
+
+def test_loose_permissions_are_tightened(tmp_path):
+    directory = tmp_path / 'cache'
+    directory.mkdir(mode=0o777)
+    os.chmod(directory, 0o777)
+    cache = DiskLRUCache(str(directory), max_bytes=1024)
+
+    assert cache.usable()
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+def test_symlinked_directory_is_not_used(tmp_path):
+    target = tmp_path / 'planted'
+    target.mkdir()
+    (target / 'entry').write_bytes(b'planted')
+    os.symlink(target, tmp_path / 'cache')
+    cache = DiskLRUCache(str(tmp_path / 'cache'), max_bytes=1024)
+
+    assert not cache.usable()
+    assert cache.read('entry') is None
+    cache.write('other', b'data')
+    assert not (target / 'other').exists()
@@ -0,0 +1,84 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from v2.ensemble_stats import ensemble_statistics, forecast_statistics, FORECAST_STATISTICS_COLUMNS
+
+QUANTILES = (0, 20, 25, 50, 75, 80, 100)
+
+
+def random_members(n_members: int, seed: int = 0) -> np.ndarray:
+    # (ensemble, time, rivid) with NaN members at some steps, every member NaN at one step and ties at another
+    rng = np.random.default_rng(seed)
+    ensembles = rng.lognormal(3, 1, (n_members, 40, 3))
+    ensembles[rng.random(ensembles.shape) < 0.1] = np.nan
+    ensembles[:, 5, 0] = np.nan
+    ensembles[:, 6, 1] = 7.5
+    return ensembles
+
+
+def nan_reference(function, ensembles):
+    # the summary statistics are NaN where any member is NaN, otherwise they equal the nan aware numpy functions
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.where(np.isnan(ensembles).any(axis=0), np.nan, function(ensembles, axis=0))
+
+
+@pytest.mark.parametrize('n_members', [1, 2, 51, 52])
+def test_ensemble_statistics_match_numpy(n_members):
+    ensembles = random_members(n_members)
+    stats = ensemble_statistics(ensembles, quantiles=QUANTILES)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for q in QUANTILES:
+            np.testing.assert_allclose(stats[q], np.nanpercentile(ensembles, q, axis=0), equal_nan=True)
+    np.testing.assert_allclose(stats['max'], nan_reference(np.nanmax, ensembles), equal_nan=True)
+    np.testing.assert_allclose(stats['min'], nan_reference(np.nanmin, ensembles), equal_nan=True)
+    np.testing.assert_allclose(stats['mean'], nan_reference(np.nanmean, ensembles), equal_nan=True)
+    np.testing.assert_allclose(stats['median'], nan_reference(np.nanmedian, ensembles), equal_nan=True)
+
+
+def test_ensemble_statistics_without_nan_match_numpy():
+    ensembles = np.random.default_rng(1).normal(10, 3, (51, 25))
+    stats = ensemble_statistics(ensembles, quantiles=(75,))
+
+    np.testing.assert_allclose(stats[75], np.percentile(ensembles, 75, axis=0))
+    np.testing.assert_allclose(stats['max'], np.max(ensembles, axis=0))
+    np.testing.assert_allclose(stats['min'], np.min(ensembles, axis=0))
+    np.testing.assert_allclose(stats['mean'], np.mean(ensembles, axis=0))
+    np.testing.assert_allclose(stats['median'], np.median(ensembles, axis=0))
+
+
+def test_ensemble_statistics_rejects_unknown_statistics_and_quantiles():
+    with pytest.raises(ValueError):
+        ensemble_statistics(np.ones((3, 2)), statistics=('std',))
+    with pytest.raises(ValueError):
+        ensemble_statistics(np.ones((3, 2)), quantiles=(101,))
+
+
+def test_forecast_statistics_match_numpy():
+    qout = random_members(52)
+    qout[0, 1, 2] = -1.0  # negative flows are counted as 0
+    ensembles = list(range(1, 53))
+    stats = forecast_statistics(qout, ensembles)
+
+    members = qout[:51].copy()
+    members[members <= 0] = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = {
+            'flow_max': nan_reference(np.nanmax, members),
+            'flow_80p': np.nanpercentile(members, 80, axis=0),
+            'flow_75p': np.nanpercentile(members, 75, axis=0),
+            'flow_avg': nan_reference(np.nanmean, members),
+            'flow_med': nan_reference(np.nanmedian, members),
+            'flow_25p': np.nanpercentile(members, 25, axis=0),
+            'flow_20p': np.nanpercentile(members, 20, axis=0),
+            'flow_min': nan_reference(np.nanmin, members),
+            'high_res': qout[51],
+        }
+    assert tuple(stats) == FORECAST_STATISTICS_COLUMNS
+    for column in FORECAST_STATISTICS_COLUMNS:
+        np.testing.assert_allclose(stats[column], expected[column], equal_nan=True, err_msg=column)
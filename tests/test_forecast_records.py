@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from v2 import data
+
+RIVER_ID = 110_000_000
+VPU = '101'
+
+
+@pytest.fixture
+def records_dir(tmp_path, monkeypatch):
+    # december of 2024 and january of 2025 in the yearly files the api reads
+    for year, start, end in ((2024, '2024-12-01', '2024-12-31 21:00'), (2025, '2025-01-01', '2025-01-31 21:00')):
+        times = pd.date_range(start, end, freq='3h')
+        xr.Dataset(
+            {'Qout': (('time', 'rivid'), np.arange(times.size, dtype=np.float32)[:, np.newaxis] + [0, 1000])},
+            coords={'time': times, 'rivid': [RIVER_ID, RIVER_ID + 3]},
+        ).to_netcdf(tmp_path / f'forecastrecord_{VPU}_{year}.nc')
+    monkeypatch.setattr(data, 'PATH_TO_FORECAST_RECORDS', str(tmp_path))
+    data._forecast_records_datasets.clear()
+    yield tmp_path
+    for _, _, dataset in data._forecast_records_datasets.values():
+        dataset.close()
+    data._forecast_records_datasets.clear()
+
+
+def test_range_across_a_year_boundary_reads_both_years(records_dir):
+    records = data.get_forecast_records(RIVER_ID, VPU, pd.Timestamp('2024-12-31'), pd.Timestamp('2025-01-01 03:00'))
+
+    assert list(records.index) == list(pd.date_range('2024-12-31', '2025-01-01 03:00', freq='3h'))
+    assert records.index.is_monotonic_increasing
+
+
+def test_range_without_records_raises(records_dir):
+    with pytest.raises(ValueError, match='no forecast records are available'):
+        data.get_forecast_records(RIVER_ID, VPU, pd.Timestamp('2025-03-01'), pd.Timestamp('2025-03-10'))
+
+
+def test_missing_earlier_year_and_no_records_in_range_raises(records_dir):
+    # there is no 2023 file and the 2024 file starts in december
+    with pytest.raises(ValueError, match='no forecast records are available'):
+        data.get_forecast_records(RIVER_ID, VPU, pd.Timestamp('2023-12-01'), pd.Timestamp('2024-11-30'))
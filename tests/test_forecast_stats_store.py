@@ -0,0 +1,39 @@
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import FORECAST_DATE, FORECAST_RIVER_IDS
+from v2 import controllers_forecasts
+from v2.data import get_precomputed_forecast_stats, forecast_stats_zarr_path
+from v2.precompute_forecast_stats import write_forecast_stats_store
+
+
+def fail_to_read_forecast(*args, **kwargs):
+    raise AssertionError('the forecast ensembles were read instead of the precomputed statistics')
+
+
+@pytest.mark.parametrize('river_id', [FORECAST_RIVER_IDS[3], FORECAST_RIVER_IDS[::-2]])
+def test_precomputed_store_matches_live_statistics(forecast_dir, monkeypatch, river_id):
+    live = controllers_forecasts.get_forecast_statistics(river_id, FORECAST_DATE)
+
+    # chunks smaller than the river count so the store is written in several appends
+    write_forecast_stats_store(FORECAST_DATE, chunk_size=2)
+    monkeypatch.setattr(controllers_forecasts, 'get_forecast_dataset', fail_to_read_forecast)
+    precomputed = controllers_forecasts.get_forecast_statistics(river_id, FORECAST_DATE)
+
+    pd.testing.assert_frame_equal(precomputed, live)
+    pd.testing.assert_frame_equal(
+        controllers_forecasts.forecast_stats(river_id, 'latest', return_format='df'),
+        controllers_forecasts.forecast_stats(river_id, FORECAST_DATE, return_format='df'),
+    )
+
+
+def test_live_statistics_are_computed_without_a_store(forecast_dir):
+    assert not os.path.exists(forecast_stats_zarr_path(FORECAST_DATE))
+    assert get_precomputed_forecast_stats(FORECAST_RIVER_IDS[0], FORECAST_DATE) is None
+
+    df = controllers_forecasts.forecast_stats(FORECAST_RIVER_IDS[0], FORECAST_DATE, return_format='df')
+    assert len(df) == 12
+    assert df['flow_max'].notna().all()
+    assert df['high_res'].isna().sum() == 4
@@ -0,0 +1,56 @@
+import pytest
+from flask import Flask, request
+
+from conftest import FORECAST_DATE, FORECAST_RIVER_IDS
+from v2 import http_cache
+
+app = Flask(__name__)
+RIVER_ID = FORECAST_RIVER_IDS[0]
+
+
+@pytest.fixture
+def retro_version(monkeypatch):
+    version = {'value': 'v2'}
+    monkeypatch.setattr(http_cache, 'retrospective_version', lambda: version['value'])
+    return version
+
+
+def validator(product='forecast', bias_corrected=False):
+    return http_cache.request_validator(product, RIVER_ID, 'json', FORECAST_DATE, None, None, bias_corrected)
+
+
+def is_not_modified(headers: dict, current: dict) -> bool:
+    with app.test_request_context(headers=headers):
+        return http_cache.is_not_modified(request, current)
+
+
+def test_matching_etag_is_answered_with_304(forecast_dir, retro_version):
+    current = validator()
+    assert is_not_modified({'If-None-Match': f'W/"{current["etag"]}"'}, current)
+    assert is_not_modified({'If-Modified-Since': current['last_modified'].strftime('%a, %d %b %Y %H:%M:%S GMT')}, current)
+
+    response = http_cache.not_modified_response(current)
+    assert response.status_code == 304
+    assert response.get_etag() == (current['etag'], True)
+    assert response.cache_control.max_age == current['max_age']
+
+
+@pytest.mark.parametrize('product, bias_corrected', [
+    ('forecast', True), ('forecaststats', True), ('hydroviewer', False), ('retrospectivedaily', False),
+])
+def test_new_retrospective_version_invalidates_dependent_responses(forecast_dir, retro_version, product,
+                                                                    bias_corrected):
+    old = validator(product, bias_corrected)
+    assert old['last_modified'] is None  # only the etag can tell that the retrospective data changed
+    assert is_not_modified({'If-None-Match': f'W/"{old["etag"]}"'}, old)
+
+    retro_version['value'] = 'v3'
+    new = validator(product, bias_corrected)
+    assert new['etag'] != old['etag']
+    assert not is_not_modified({'If-None-Match': f'W/"{old["etag"]}"'}, new)
+
+
+def test_new_retrospective_version_keeps_uncorrected_forecast_etags(forecast_dir, retro_version):
+    old = validator('forecast')
+    retro_version['value'] = 'v3'
+    assert validator('forecast') == old
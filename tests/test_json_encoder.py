@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+import pandas as pd
+from flask import Flask, jsonify
+
+from v2.response_formatters import _encode_json, df_to_jsonify_response
+
+app = Flask(__name__)
+
+
+def old_jsonify(value) -> object:
+    # the serializer the API used before the encoder, NaN replaced by "" and datetimes formatted first
+    with app.app_context():
+        return json.loads(jsonify(value).get_data())
+
+
+def encode(value) -> object:
+    return json.loads(_encode_json(value))
+
+
+def sample_frame() -> pd.DataFrame:
+    index = pd.date_range('2024-01-01', periods=6, freq='3h', name='datetime')
+    return pd.DataFrame({
+        'flow': [1.5, np.nan, 2.25, 0.0, -3.125, 1e6],
+        'flow_32': np.array([1.5, np.nan, 2.25, 0.0, -3.125, 7.0], dtype=np.float32),
+        'count': np.arange(6, dtype=np.int64),
+        'label': list('abcdef'),
+    }, index=index)
+
+
+def test_arrays_match_the_old_serializer():
+    df = sample_frame()
+    old = df.copy()
+    old.index = old.index.strftime('%Y-%m-%dT%X+00:00')
+    expected = {'datetime': old.index.tolist(), **old.replace(np.nan, '').to_dict(orient='list')}
+
+    encoded = encode({'datetime': df.index.values, **{column: df[column].values for column in df.columns}})
+    assert encoded == old_jsonify(expected)
+
+
+def test_datetime64_with_nat_is_written_as_null():
+    values = np.array(['2024-01-01T03:00', 'NaT'], dtype='datetime64[ns]')
+    assert encode({'datetime': values}) == {'datetime': ['2024-01-01T03:00:00+00:00', None]}
+
+
+def test_scalars_and_lists_match_the_old_serializer():
+    value = {'int': 3, 'float': 2.5, 'np_float': np.float64(10.75), 'text': 'x', 'none': None, 'list': [1, 2.5, 'a']}
+    assert encode(value) == old_jsonify(value)
+    assert encode({'np_int': np.int64(7), 'np_float32': np.float32(0.5)}) == {'np_int': 7, 'np_float32': 0.5}
+
+
+def test_nan_and_infinity_become_empty_strings_everywhere():
+    value = {
+        'scalar_nan': float('nan'),
+        'np_nan': np.float64('nan'),
+        'np_inf': np.float32('inf'),
+        'list': [1.0, float('nan'), float('-inf')],
+        'array': np.array([np.nan, 1.0, np.inf]),
+        'nested': {'rp': {2: np.float64('nan'), 5: 4.5}},
+    }
+    assert encode(value) == {
+        'scalar_nan': '',
+        'np_nan': '',
+        'np_inf': '',
+        'list': [1.0, '', ''],
+        'array': ['', 1.0, ''],
+        'nested': {'rp': {'2': '', '5': 4.5}},
+    }
+
+
+def test_dataframe_response_matches_the_old_response():
+    df = sample_frame()
+    with app.app_context():
+        response = json.loads(df_to_jsonify_response(df.copy(), river_id=110000000).get_data())
+
+    old = df.copy()
+    old.index = old.index.strftime('%Y-%m-%dT%X+00:00')
+    assert response['metadata']['start_date'] == '2024-01-01T00:00:00+00:00'
+    assert response['metadata']['end_date'] == '2024-01-01T15:00:00+00:00'
+    assert response['datetime'] == old.index.tolist()
+    for column, values in old_jsonify(old.replace(np.nan, '').to_dict(orient='list')).items():
+        assert response[column] == values
@@ -0,0 +1,33 @@
+import pytest
+from flask import Flask, request
+
+from v2 import blueprint
+
+app = Flask(__name__)
+
+
+@pytest.fixture(autouse=True)
+def every_river_id_is_valid(monkeypatch):
+    monkeypatch.setattr(blueprint, 'is_valid_river_id', lambda river_id: True)
+
+
+def handle(path_river_id, query_string=None, product='forecast'):
+    with app.test_request_context(query_string=query_string or {}):
+        return blueprint.handle_request(request, product, path_river_id)
+
+
+@pytest.mark.parametrize('path_river_id', [',', ',,', ' , '])
+def test_empty_river_id_lists_are_rejected(path_river_id):
+    with pytest.raises(ValueError, match='you must specify a river ID number'):
+        handle(path_river_id)
+
+
+def test_duplicate_river_ids_are_read_once_in_request_order():
+    product, river_id, *_ = handle('110000003,110000000,110000003,')
+    assert product == 'forecast'
+    assert river_id == [110000003, 110000000]
+
+
+def test_river_id_lists_are_only_accepted_by_multi_river_products():
+    with pytest.raises(ValueError, match='accept more than one river ID'):
+        handle('110000000,110000003', product='retrospectivedaily')